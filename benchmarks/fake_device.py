@@ -0,0 +1,316 @@
+"""Simulated MicroPython device for benchmarks
+
+FakeDevice serves the raw REPL protocol (including raw-paste mode) on a
+pseudo terminal. The kernel connects to it like to a board on a USB port,
+e.g. %connect 'serial:///dev/pts/5'. Code is executed by CPython in a
+persistent namespace with stand-ins for the MicroPython modules used by
+the kernel and iot_device:
+
+    os        file system rooted in a host directory, MicroPython stat layout
+    time      ticks_us, ticks_ms, ticks_diff, sleep_ms, sleep_us
+    machine   unique_id, RTC, reset
+    sys       sys.implementation.name == 'micropython'
+
+Like on MicroPython, ctrl-C interrupts running code (checked in sleep
+and print).
+
+Optionally the link speed is limited (baud) to model a serial port.
+
+Usage (stand-alone):
+    python benchmarks/fake_device.py --root /tmp/mcu
+"""
+
+import builtins, os, pty, select, sys, threading, time, traceback, tty, types
+
+RAW_REPL_BANNER = b"raw REPL; CTRL-B to exit\r\n>"
+FRIENDLY_BANNER = b"\r\nMicroPython (fake) on benchmark device\r\n>>> "
+PASTE_WINDOW = 256
+
+# MicroPython epoch (2000-01-01) relative to unix epoch
+EPOCH_2000 = 946684800
+
+
+class FakeDevice:
+
+    def __init__(self, root, uid=b'\xfa\xce\x00\x00\x00\x01', baud=None, platform='fake'):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.uid = uid
+        self.baud = baud
+        self.platform = platform
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._reset()
+
+    @property
+    def url(self):
+        return f"serial://{self.port}"
+
+    @property
+    def uid_str(self):
+        return ':'.join(f"{x:02x}" for x in self.uid)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    ###########################################################################
+    # protocol
+
+    def _write(self, data):
+        if self.baud:
+            time.sleep(len(data) * 10 / self.baud)
+        while data:
+            n = os.write(self._master, data)
+            data = data[n:]
+
+    def _serve(self):
+        mode = 'friendly'
+        code = bytearray()
+        pending = self._pending = bytearray()
+        pasted = 0
+        while not self._stop.is_set():
+            r, _, _ = select.select([self._master], [], [], 0.1)
+            if not r: continue
+            try:
+                pending.extend(os.read(self._master, 4096))
+            except OSError:
+                time.sleep(0.01)
+                continue
+            while pending:
+                if mode == 'paste':
+                    i = pending.find(b'\x04')
+                    chunk = pending if i < 0 else pending[:i]
+                    code.extend(chunk)
+                    # flow control: request next window
+                    for _ in range((pasted + len(chunk)) // PASTE_WINDOW - pasted // PASTE_WINDOW):
+                        self._write(b'\x01')
+                    pasted += len(chunk)
+                    if i < 0:
+                        pending.clear()
+                        break
+                    del pending[:i+1]
+                    self._write(b'\x04')
+                    self._execute(bytes(code))
+                    code.clear()
+                    mode = 'raw'
+                    continue
+                c = pending[0]
+                if mode == 'raw' and c == 0x05:
+                    if len(pending) < 3: break
+                    if pending[:3] == b'\x05A\x01':
+                        del pending[:3]
+                        self._write(b'R\x01' + bytes([PASTE_WINDOW & 0xff, PASTE_WINDOW >> 8]))
+                        code.clear()
+                        pasted = 0
+                        mode = 'paste'
+                        continue
+                del pending[0]
+                if c == 0x01:
+                    # ctrl-A: enter raw repl
+                    code.clear()
+                    mode = 'raw'
+                    self._write(RAW_REPL_BANNER)
+                elif c == 0x02:
+                    # ctrl-B: friendly repl
+                    mode = 'friendly'
+                    self._write(FRIENDLY_BANNER)
+                elif c == 0x03:
+                    # ctrl-C
+                    code.clear()
+                    if mode == 'friendly':
+                        self._write(b"\r\n>>> ")
+                elif mode == 'raw':
+                    if c == 0x04:
+                        if code:
+                            self._write(b'OK')
+                            self._execute(bytes(code))
+                            code.clear()
+                        else:
+                            # soft reset
+                            self._write(b"OK\r\nMPY: soft reboot\r\n")
+                            self._reset()
+                            self._write(RAW_REPL_BANNER)
+                    else:
+                        code.append(c)
+
+    def _poll_interrupt(self):
+        # raise KeyboardInterrupt if ctrl-C was received, keep other input
+        while select.select([self._master], [], [], 0)[0]:
+            data = os.read(self._master, 4096)
+            i = data.find(b'\x03')
+            if i >= 0:
+                self._pending.extend(data[i+1:])
+                raise KeyboardInterrupt()
+            self._pending.extend(data)
+
+    def _sleep(self, t):
+        end = time.monotonic() + t
+        while True:
+            self._poll_interrupt()
+            left = end - time.monotonic()
+            if left <= 0: return
+            time.sleep(min(left, 0.01))
+
+    def _execute(self, code):
+        err = b''
+        try:
+            exec(compile(code.decode(), '<stdin>', 'exec'), self._globals)
+        except _SoftReset:
+            self._reset()
+        except BaseException as e:
+            tb = traceback.extract_tb(e.__traceback__)
+            line = next((f.lineno for f in reversed(tb) if f.filename == '<stdin>'), 1)
+            err = (f'Traceback (most recent call last):\r\n  File "<stdin>", line {line}, in <module>\r\n'
+                   f'{type(e).__name__}: {e}\r\n').encode()
+        self._write(b'\x04' + err + b'\x04>')
+
+    ###########################################################################
+    # MicroPython environment
+
+    def _reset(self):
+        self._cwd = '/'
+        self._modules = {
+            'os': self._os_module(),
+            'time': self._time_module(),
+            'machine': self._machine_module(),
+            'sys': self._sys_module(),
+        }
+        for name in list(self._modules):
+            self._modules['u' + name] = self._modules[name]
+        b = dict(vars(builtins))
+        b.update(__import__=self._import, open=self._open, print=self._print,
+                 exec=self._exec, eval=self._eval)
+        self._builtins = b
+        self._globals = { '__builtins__': b, '__name__': '__main__' }
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        module = self._modules.get(name)
+        if module: return module
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    def _exec(self, code, g=None, l=None):
+        if g is None: g = sys._getframe(1).f_globals
+        g.setdefault('__builtins__', self._builtins)
+        return builtins.exec(code, g, l)
+
+    def _eval(self, code, g=None, l=None):
+        if g is None: g = sys._getframe(1).f_globals
+        g.setdefault('__builtins__', self._builtins)
+        return builtins.eval(code, g, l)
+
+    def _print(self, *args, sep=' ', end='\n', file=None):
+        self._poll_interrupt()
+        text = sep.join(str(a) for a in args) + end
+        self._write(text.replace('\n', '\r\n').encode())
+
+    def _path(self, path=''):
+        # host path of device path
+        path = path if path.startswith('/') else os.path.join(self._cwd, path)
+        path = os.path.normpath(path).lstrip('/')
+        return os.path.join(self.root, path)
+
+    def _open(self, path, mode='r', *args, **kwargs):
+        return builtins.open(self._path(path), mode, *args, **kwargs)
+
+    def _os_module(self):
+        dev = self
+        m = types.ModuleType('os')
+        def stat(path):
+            st = os.stat(dev._path(path))
+            mtime = int(st.st_mtime) - EPOCH_2000
+            mode = 0x4000 if os.path.isdir(dev._path(path)) else 0x8000
+            return (mode, 0, 0, 0, 0, 0, st.st_size, mtime, mtime, mtime)
+        def chdir(path):
+            p = dev._path(path)
+            if not os.path.isdir(p): raise OSError(2, 'ENOENT')
+            rel = os.path.relpath(p, dev.root)
+            dev._cwd = '/' if rel == '.' else '/' + rel
+        def ilistdir(path=''):
+            for name in os.listdir(dev._path(path)):
+                p = os.path.join(dev._path(path), name)
+                yield (name, 0x4000 if os.path.isdir(p) else 0x8000, 0, os.path.getsize(p))
+        m.stat = stat
+        m.listdir = lambda path='': sorted(os.listdir(dev._path(path)))
+        m.ilistdir = ilistdir
+        m.mkdir = lambda path: os.mkdir(dev._path(path))
+        m.rmdir = lambda path: os.rmdir(dev._path(path))
+        m.remove = lambda path: os.remove(dev._path(path))
+        m.rename = lambda a, b: os.rename(dev._path(a), dev._path(b))
+        m.getcwd = lambda: dev._cwd
+        m.chdir = chdir
+        m.sep = '/'
+        m.uname = lambda: ('fake', 'fake', '1.0', 'v1.0', dev.platform)
+        m.statvfs = lambda path: (4096, 4096, 1024, 512, 512, 0, 0, 0, 0, 255)
+        return m
+
+    def _time_module(self):
+        m = types.ModuleType('time')
+        for name in ('time', 'localtime', 'mktime', 'gmtime', 'monotonic', 'monotonic_ns', 'time_ns'):
+            setattr(m, name, getattr(time, name))
+        m.ticks_us = lambda: time.perf_counter_ns() // 1000
+        m.ticks_ms = lambda: time.perf_counter_ns() // 1000000
+        m.ticks_diff = lambda a, b: a - b
+        m.ticks_add = lambda a, b: a + b
+        m.sleep = self._sleep
+        m.sleep_ms = lambda t: self._sleep(t / 1000)
+        m.sleep_us = lambda t: self._sleep(t / 1e6)
+        return m
+
+    def _machine_module(self):
+        dev = self
+        m = types.ModuleType('machine')
+        class RTC:
+            def datetime(self, *args): return tuple(time.localtime())[:8]
+        def reset():
+            raise _SoftReset()
+        m.unique_id = lambda: dev.uid
+        m.RTC = RTC
+        m.reset = reset
+        m.freq = lambda *args: 240000000
+        return m
+
+    def _sys_module(self):
+        m = types.ModuleType('sys')
+        m.implementation = types.SimpleNamespace(name='micropython', version=(1, 20, 0))
+        m.platform = self.platform
+        m.version = '3.4.0'
+        m.maxsize = 2**31 - 1
+        m.byteorder = 'little'
+        m.modules = {}
+        m.path = ['', '/lib']
+        m.stdout = types.SimpleNamespace(write=lambda s: self._print(s, end=''))
+        m.print_exception = lambda e: self._print(f"{type(e).__name__}: {e}")
+        return m
+
+
+class _SoftReset(BaseException):
+    pass
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulated MicroPython device on a pseudo terminal")
+    parser.add_argument('--root', required=True, help="host directory holding the device file system")
+    parser.add_argument('--baud', type=int, default=None, help="limit output to baud (bits/s)")
+    args = parser.parse_args()
+    dev = FakeDevice(args.root, baud=args.baud).start()
+    print(f"{dev.url}  uid {dev.uid_str}  (ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        dev.stop()
+
+
+if __name__ == '__main__':
+    main()
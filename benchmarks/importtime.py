@@ -0,0 +1,99 @@
+"""Kernel startup cost: import time of iot_kernel.kernel & first magic call
+
+Each measurement runs in a fresh interpreter. ipykernel is imported first
+so that only the cost added by iot_kernel is reported.
+
+Usage:
+    python benchmarks/importtime.py                 # current tree
+    python benchmarks/importtime.py --rev HEAD~1    # compare with a git revision
+    python benchmarks/importtime.py --top 15        # largest imports
+"""
+
+import argparse, json, os, statistics, subprocess, sys, tarfile, tempfile, io
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_MEASURE = r"""
+import time, json, sys
+import ipykernel.ipkernel
+t0 = time.perf_counter()
+import iot_kernel.kernel
+t1 = time.perf_counter()
+from iot_kernel.magics.magic import LINE_MAGIC
+
+class _Kernel:
+    def print(self, *args, **kwargs): pass
+    def error(self, *args, **kwargs): pass
+
+# first line magic: load module & parse arguments
+LINE_MAGIC.get('lsmagic')[0](_Kernel(), '-h')
+t2 = time.perf_counter()
+print(json.dumps({ 'import': t1-t0, 'first_magic': t2-t1,
+                   'modules': len(sys.modules),
+                   'paramiko': 'paramiko' in sys.modules }))
+"""
+
+
+def measure(path, runs):
+    env = dict(os.environ, PYTHONPATH=path)
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', _MEASURE], env=env, cwd=tempfile.gettempdir(),
+                             check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.splitlines()[-1]))
+    return {
+        'import_ms': 1000 * statistics.median(r['import'] for r in results),
+        'first_magic_ms': 1000 * statistics.median(r['first_magic'] for r in results),
+        'modules': results[-1]['modules'],
+        'paramiko_loaded': results[-1]['paramiko'],
+    }
+
+
+def top_imports(path, n):
+    # cumulative import times (us) of iot_kernel.kernel, -X importtime
+    env = dict(os.environ, PYTHONPATH=path)
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ipykernel.ipkernel; import iot_kernel.kernel'],
+                         env=env, cwd=tempfile.gettempdir(), check=True, capture_output=True, text=True).stderr
+    # only imports after ipykernel
+    lines = err.split('| ipykernel.ipkernel\n', 1)[-1].splitlines()
+    rows = []
+    for line in lines:
+        if not line.startswith('import time:'): continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def checkout(rev, dst):
+    archive = subprocess.run(['git', 'archive', rev, 'iot_kernel'], cwd=ROOT, check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(dst)
+    return dst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure iot_kernel import time and first magic latency")
+    parser.add_argument('--rev', help="git revision to compare with")
+    parser.add_argument('--runs', type=int, default=5, help="runs per measurement (median is reported)")
+    parser.add_argument('--top', type=int, default=0, help="show the N slowest imports")
+    parser.add_argument('--json', help="write results to file")
+    args = parser.parse_args()
+
+    results = { 'current': measure(ROOT, args.runs) }
+    if args.rev:
+        with tempfile.TemporaryDirectory() as tmp:
+            results[args.rev] = measure(checkout(args.rev, tmp), args.runs)
+    for name, r in results.items():
+        print(f"{name:>12}: import {r['import_ms']:7.1f} ms   first magic {r['first_magic_ms']:6.1f} ms   "
+              f"{r['modules']} modules   paramiko {'loaded' if r['paramiko_loaded'] else 'not loaded'}")
+    if args.top:
+        print(f"\n{'cumulative us':>14}  module")
+        for us, name in top_imports(ROOT, args.top):
+            print(f"{us:14}  {name}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
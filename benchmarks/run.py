@@ -0,0 +1,254 @@
+"""Kernel benchmarks against simulated devices
+
+Starts an iot_kernel process (through jupyter_client, like a notebook
+would) and a set of FakeDevice's on pseudo terminals, then measures
+
+    cell_latency     execution time of a trivial cell, with and without
+                     reusing the raw repl session between cells
+    output           cell printing many lines (iopub message volume)
+    cp               %cp throughput, one large file and many small files
+    rsync            %rsync of a large tree: initial, unchanged, 3 edits;
+                     %deploy of the same tree
+    connect_all      %%connect --all, sequential and --parallel
+
+Everything (HOME, IOT_PROJECTS, device file systems) lives in a
+temporary directory. Results are printed and written to a JSON file for
+tracking regressions over time.
+
+Usage:
+    python benchmarks/run.py                          # all benchmarks
+    python benchmarks/run.py cell_latency output      # selected benchmarks
+    python benchmarks/run.py --devices 8 --output results.json
+    python benchmarks/run.py --baud 115200            # model a serial link
+"""
+
+import argparse, json, os, platform, statistics, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_device import FakeDevice
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Kernel:
+    """iot_kernel in a subprocess, driven through jupyter_client"""
+
+    def __init__(self, env, cwd):
+        from jupyter_client import KernelManager
+        from jupyter_client.kernelspec import KernelSpec
+        self.km = KernelManager()
+        self.km._kernel_spec = KernelSpec(
+            argv=[sys.executable, '-m', 'iot_kernel', '-f', '{connection_file}'],
+            display_name='IoT Kernel (benchmark)', language='python')
+        self.km.start_kernel(env=env, cwd=cwd)
+        self.kc = self.km.client()
+        self.kc.start_channels()
+        self.kc.wait_for_ready(timeout=60)
+        # not a notebook: the first setting stored (%connect, %cd) reports that it is not saved
+        self.execute("%cd .", check=False)
+
+    def execute(self, code, timeout=600, check=True):
+        """Run cell, returns dict with elapsed time and output statistics"""
+        start = time.perf_counter()
+        msg_id = self.kc.execute(code)
+        messages = 0
+        out, err = [], []
+        while True:
+            msg = self.kc.get_iopub_msg(timeout=timeout)
+            if msg['parent_header'].get('msg_id') != msg_id: continue
+            typ = msg['msg_type']
+            if typ == 'stream':
+                messages += 1
+                (out if msg['content']['name'] == 'stdout' else err).append(msg['content']['text'])
+            elif typ in ('display_data', 'update_display_data', 'execute_result'):
+                messages += 1
+            elif typ == 'status' and msg['content']['execution_state'] == 'idle':
+                break
+        elapsed = time.perf_counter() - start
+        out, err = ''.join(out), ''.join(err)
+        if check and err.strip():
+            raise RuntimeError(f"cell failed:\n{code}\n----\n{err}")
+        return { 'elapsed': elapsed, 'messages': messages, 'stdout': out, 'stderr': err }
+
+    def shutdown(self):
+        self.kc.stop_channels()
+        self.km.shutdown_kernel(now=True)
+
+
+###############################################################################
+# benchmarks
+
+def cell_latency(k, devices, args):
+    k.execute(f"%connect '{devices[0].url}' -q")
+    result = {}
+    for idle in (0, 60):
+        k.execute(f"%session --idle {idle}\n%session --close")
+        times = [ k.execute("x = 1")['elapsed'] for _ in range(args.repeat) ]
+        result[f"idle_{idle}"] = _summary(times)
+    k.execute("%session --idle 0\n%session --close")
+    return result
+
+
+def output(k, devices, args):
+    k.execute(f"%connect '{devices[0].url}' -q")
+    lines = 20000
+    r = k.execute(f"for i in range({lines}):\n    print(i)")
+    return { 'lines': lines, 'elapsed': r['elapsed'], 'lines_per_s': lines / r['elapsed'],
+             'iopub_messages': r['messages'], 'chars': len(r['stdout']) }
+
+
+def cp(k, devices, args, work):
+    k.execute(f"%connect '{devices[0].url}' -q")
+    big = os.path.join(work, 'big.bin')
+    with open(big, 'wb') as f:
+        f.write(os.urandom(256 * 1024))
+    small = os.path.join(work, 'small')
+    _tree(small, 100, 1, 1024)
+    result = {}
+    r = k.execute(f"%cp -q {big} :/big.bin")
+    result['large'] = { 'bytes': os.path.getsize(big), 'elapsed': r['elapsed'],
+                        'kB_per_s': os.path.getsize(big) / 1024 / r['elapsed'] }
+    # change a few bytes: delta upload
+    with open(big, 'r+b') as f:
+        f.seek(100 * 1024)
+        f.write(b'changed')
+    r = k.execute(f"%cp -q {big} :/big.bin")
+    result['large_delta'] = { 'elapsed': r['elapsed'] }
+    size = sum(os.path.getsize(os.path.join(small, f)) for f in os.listdir(small))
+    r = k.execute(f"%cp -q -r {small} :/")
+    result['small'] = { 'files': 100, 'bytes': size, 'elapsed': r['elapsed'],
+                        'files_per_s': 100 / r['elapsed'] }
+    return result
+
+
+def rsync(k, devices, args, work):
+    dev = devices[0]
+    _clear(dev.root)
+    project = os.path.join(work, 'project')
+    files = _tree(os.path.join(project, 'code'), args.files, 8, 2048)
+    k.execute(f"%connect '{dev.url}' -q")
+    result = {}
+    result['initial'] = { 'files': files, 'elapsed': k.execute("%rsync")['elapsed'] }
+    result['unchanged'] = { 'elapsed': k.execute("%rsync")['elapsed'] }
+    for name in sorted(os.listdir(os.path.join(project, 'code', 'd0')))[:3]:
+        with open(os.path.join(project, 'code', 'd0', name), 'a') as f:
+            f.write("# edit\n")
+    result['edit_3'] = { 'elapsed': k.execute("%rsync")['elapsed'] }
+    _clear(dev.root)
+    result['deploy_initial'] = { 'elapsed': k.execute("%deploy")['elapsed'] }
+    return result
+
+
+def connect_all(k, devices, args):
+    register = '\n'.join(f"%connect '{d.url}' -q" for d in devices)
+    result = { 'devices': len(devices) }
+    for name, flags in (('sequential', ''), ('parallel', f"--parallel {len(devices)}")):
+        # devices not seen for 10s are dropped from the registry
+        k.execute(register)
+        r = k.execute(f"%%connect --all -q {flags}\nimport time\ntime.sleep(0.05)\nprint('hello')")
+        result[name] = { 'elapsed': r['elapsed'] }
+    return result
+
+
+BENCHMARKS = {
+    'cell_latency': cell_latency,
+    'output': output,
+    'cp': cp,
+    'rsync': rsync,
+    'connect_all': connect_all,
+}
+
+
+###############################################################################
+# helpers
+
+def _summary(times):
+    return { 'n': len(times), 'mean': statistics.mean(times), 'median': statistics.median(times),
+             'min': min(times), 'max': max(times) }
+
+
+def _tree(path, files, dirs, size):
+    # create files spread over dirs directories, returns number of files
+    for i in range(files):
+        d = os.path.join(path, f"d{i % dirs}") if dirs > 1 else path
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f"m{i}.py"), 'w') as f:
+            line = f"value_{i} = {i}  # padding\n"
+            f.write(line * (size // len(line) + 1))
+    return files
+
+
+def _clear(root):
+    for name in os.listdir(root):
+        subprocess.run(['rm', '-rf', os.path.join(root, name)], check=True)
+
+
+def _git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark iot_kernel against simulated devices")
+    parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--devices', type=int, default=4, help="number of simulated devices (default: 4)")
+    parser.add_argument('--files', type=int, default=300, help="files in the rsync tree (default: 300)")
+    parser.add_argument('--repeat', type=int, default=20, help="repetitions for latency measurements (default: 20)")
+    parser.add_argument('--baud', type=int, default=None, help="limit device output rate (bits/s)")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON result file")
+    args = parser.parse_args()
+    selected = args.benchmarks or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark '{name}'")
+
+    with tempfile.TemporaryDirectory(prefix='iot49_bench_') as tmp:
+        home = os.path.join(tmp, 'home')
+        projects = os.path.join(tmp, 'projects')
+        work = os.path.join(tmp, 'work')
+        for d in (home, projects, work):
+            os.makedirs(d)
+        devices = [ FakeDevice(os.path.join(tmp, f"mcu{i}"), uid=bytes([0xfa, 0xce, 0, 0, 0, i+1]),
+                               baud=args.baud).start() for i in range(args.devices) ]
+        # configuration of device 0 for %rsync
+        os.makedirs(os.path.join(projects, 'devices'))
+        with open(os.path.join(projects, 'devices', 'bench.yaml'), 'w') as f:
+            f.write(f"bench0:\n    uid: {devices[0].uid_str}\n    path: {os.path.join(work, 'project')}\n"
+                    f"    resources:\n        - code:\n            install-dir: /\n")
+        env = dict(os.environ, HOME=home, IOT_PROJECTS=projects,
+                   PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+        kernel = Kernel(env, work)
+        results = {}
+        try:
+            for name in selected:
+                fn = BENCHMARKS[name]
+                kw = { 'work': work } if 'work' in fn.__code__.co_varnames else {}
+                start = time.perf_counter()
+                results[name] = fn(kernel, devices, args, **kw)
+                print(f"{name:14} {time.perf_counter()-start:7.2f}s  {json.dumps(results[name])}")
+        finally:
+            kernel.shutdown()
+            for dev in devices:
+                dev.stop()
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git': _git_rev(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'devices': args.devices,
+            'baud': args.baud,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
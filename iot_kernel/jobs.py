@@ -0,0 +1,137 @@
+from iot_device import RemoteError
+from .session import Session
+from .kernel_logger import logger
+from collections import OrderedDict
+import threading, time
+
+"""Background jobs (%%connect --background).
+
+A job runs a cell on one device in its own thread and raw repl session,
+while the kernel continues to serve other cells. Output is sent with the
+parent header of the cell that started the job, i.e. it appears in that
+cell's output area even after the cell has finished. A status line
+(display id iot49-job-N) is updated when the job ends.
+
+While a job runs, other cells cannot use its device. %kill interrupts
+the job by sending ctrl-C to the device.
+"""
+
+class Job:
+
+    def __init__(self, id, kernel, device, code):
+        self.id = id
+        self.device = device
+        self.code = code
+        self.status = 'running'
+        self.start = time.monotonic()
+        self.end = None
+        self.killed = False
+        self._kernel = kernel
+        # parent header of the cell that started the job
+        self._parent = kernel.get_parent()
+        self._session = Session(device, lambda: True, kernel.stats)
+        self._thread = threading.Thread(target=self._run, name=f"iot49-job-{id}", daemon=True)
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def is_running(self):
+        return self.end is None
+
+    @property
+    def display_id(self):
+        return f"iot49-job-{self.id}"
+
+    def kill(self):
+        """Interrupt the code running on the device (ctrl-C)"""
+        if not self.is_running: return
+        self.killed = True
+        try:
+            self.device.write(b'\r\x03\x03')
+        except Exception as e:
+            # e.g. connection not (yet) open
+            logger.info(f"job {self.id}: kill {self.device.name}: {e}")
+
+    def _run(self):
+        from . import StopDoExecute
+        kernel = self._kernel
+        self._display('display_data')
+        status = 'done'
+        try:
+            tail = kernel.tail_view(self._parent)
+            with kernel.device_context(self.device, self._send_stream, interval=0.05,
+                                       session=self._session, tail=tail):
+                try:
+                    kernel.execute_cell(self.code)
+                except StopDoExecute:
+                    status = 'error'
+                except Exception as e:
+                    # e.g. RemoteError (exception on device), SerialException
+                    if not self.killed: kernel.error(str(e), end="")
+                    status = 'error'
+        finally:
+            self._session.close()
+            self.end = time.monotonic()
+            self.status = 'killed' if self.killed else status
+            self._display('update_display_data')
+
+    def _send(self, msg_type, content):
+        self._kernel.send_iopub(msg_type, content, self._parent)
+
+    def _send_stream(self, name, text):
+        self._send('stream', { 'name': name, 'text': text })
+
+    def _display(self, msg_type):
+        text = f"[job {self.id}] {self.device.name}: {self.status}"
+        if not self.is_running: text += f" ({self.elapsed:.1f}s)"
+        self._send(msg_type, {
+            'data': { 'text/plain': text },
+            'metadata': {},
+            'transient': { 'display_id': self.display_id },
+        })
+
+
+class Jobs:
+
+    def __init__(self, kernel):
+        self._kernel = kernel
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._jobs.values()))
+
+    def get(self, id):
+        with self._lock:
+            return self._jobs.get(id)
+
+    def start(self, device, code):
+        """Run code on device in the background"""
+        # release the kernel's session, the job opens its own
+        self._kernel.repl_session_for(device).close()
+        with self._lock:
+            job = self.busy(device)
+            if job:
+                raise RemoteError(f"{device.name} is busy with job {job.id}")
+            job = Job(self._next_id, self._kernel, device, code)
+            self._jobs[job.id] = job
+            self._next_id += 1
+        job._thread.start()
+        return job
+
+    def busy(self, device):
+        """Job running on device, None if device is free"""
+        for job in list(self._jobs.values()):
+            if job.device is device and job.is_running:
+                return job
+        return None
+
+    def clear(self):
+        """Forget finished jobs"""
+        with self._lock:
+            for id in [ id for id, job in self._jobs.items() if not job.is_running ]:
+                del self._jobs[id]
@@ -3,21 +3,38 @@ from iot_device import RemoteError
 import iot_device
 
 from .nb_conf import NbConf
+from .output import OutputBuffer, TailView
+from .session import Session
+from .stats import Stats, HOST
+from .recorder import Recorder
+from .jobs import Jobs
 from .kernel_logger import logger
 from .magics.magic import LINE_MAGIC, CELL_MAGIC
 from .version import __version__
 
-from serial import SerialException
-from websocket import WebSocketException
 from ipykernel.ipkernel import IPythonKernel
 from termcolor import colored
 from subprocess import Popen, PIPE, STDOUT
-import traceback, re, os, time, logging
+from contextlib import contextmanager
+import traceback, threading, re, os, time, logging
 
 
 class StopDoExecute(Exception):
     pass
 
+# %name rest
+_LINE_MAGIC_RE = re.compile(r'%([^ ]*)( .*)?')
+
+
+# serial & websocket are imported only if an exception needs to be classified
+def _serial_errors():
+    from serial import SerialException
+    return (SerialException, ConnectionResetError, ConnectionRefusedError)
+
+def _websocket_errors():
+    from websocket import WebSocketException
+    return WebSocketException
+
 class IoTKernel(IPythonKernel):
     """
     IoT kernel evaluates code on (remote) IoT devices.
@@ -41,6 +58,27 @@ class IoTKernel(IPythonKernel):
         self.__device_registry = DeviceRegistry()
         # current device
         self.__device = None
+        # per-thread device & output capture (e.g. %%connect --parallel)
+        self.__local = threading.local()
+        # coalesce output into fewer iopub messages
+        self.__output = OutputBuffer(self._send_stream)
+        # %output tail: (lines, refresh interval) or None; view of the current cell
+        self.output_tail = None
+        self.__tail = None
+        self.__tail_count = 0
+        # raw repl sessions (device --> Session), held open for the duration of a cell
+        self.__sessions = {}
+        self.__sessions_lock = threading.Lock()
+        self.__cell_depth = 0
+        # seconds sessions stay open after a cell ends
+        self.session_idle_timeout = 0
+        # transport & execution statistics (%stats)
+        self.stats = Stats()
+        self.__names = {}
+        # byte stream recording (%record)
+        self.recorder = Recorder()
+        # %%connect --background
+        self.jobs = Jobs(self)
         # initial host is location of notebook
         # os.chdir(self.nb_conf.get("cwd", os.path.expanduser('~')))
 
@@ -54,6 +92,8 @@ class IoTKernel(IPythonKernel):
 
     @property
     def device(self):
+        dev = getattr(self.__local, 'device', None)
+        if dev: return dev
         if not self.__device:
             self.__device = self.device_registry.get_device(self.nb_conf.get("device"))
             if self.__device:
@@ -64,13 +104,78 @@ class IoTKernel(IPythonKernel):
 
     @device.setter
     def device(self, dev):
-        self.__device = dev
+        if getattr(self.__local, 'device', None):
+            self.__local.device = dev
+        else:
+            self.__device = dev
+
+    @contextmanager
+    def device_context(self, dev, sink, interval=None, session=None, tail=None):
+        """Run code in the current thread on dev.
+        Output is passed to sink(stream_name, text), coalesced every interval seconds.
+        session: raw repl session to use instead of the kernel's session of dev.
+        tail: TailView receiving device output."""
+        self.__local.device = dev
+        self.__local.output = OutputBuffer(sink, interval=interval)
+        self.__local.session = session
+        self.__local.tail = tail
+        try:
+            yield
+        finally:
+            self.__local.output.flush(final=True)
+            if tail: tail.flush(final=True)
+            self.__local.device = None
+            self.__local.output = None
+            self.__local.session = None
+            self.__local.tail = None
+
+    @property
+    def repl_session(self):
+        """Raw repl session of current device. Usage:
+
+        with kernel.repl_session as repl:
+            repl.exec(...)
+        """
+        session = getattr(self.__local, 'session', None)
+        if session: return session
+        return self.repl_session_for(self.device)
+
+    def repl_session_for(self, dev):
+        """Raw repl session of device dev"""
+        job = self.jobs.busy(dev)
+        if job:
+            raise RemoteError(f"{dev.name} is busy with job {job.id} (stop it with %kill {job.id})")
+        with self.__sessions_lock:
+            session = self.__sessions.get(dev)
+            if not session:
+                session = self.__sessions[dev] = Session(dev, lambda: self.__cell_depth > 0, self.stats)
+        session.idle_timeout = self.session_idle_timeout
+        return session
+
+    @property
+    def repl_sessions(self):
+        with self.__sessions_lock:
+            return list(self.__sessions.values())
+
+    @contextmanager
+    def cell_scope(self):
+        """Keep sessions open until the end of the scope"""
+        self.__cell_depth += 1
+        try:
+            yield
+        finally:
+            self.__cell_depth -= 1
+            if self.__cell_depth == 0:
+                for session in self.repl_sessions:
+                    session.idle_timeout = self.session_idle_timeout
+                    session.release()
 
     def set_default_device(self, uid_or_name_or_path):
         self.nb_conf.set("device", uid_or_name_or_path)
 
     def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
         self.silent = silent
+        self.stats.begin_cell()
         try:
             if not code.startswith('%%'):
                 code = '%%connect\n' + code
@@ -78,24 +183,35 @@ class IoTKernel(IPythonKernel):
             magic, args = (head + ' ').split(' ', 1)
             if magic == '%%host':
                 # pass directly to host
+                self.__output.flush()
                 return super().do_execute(code, silent, store_history, user_expressions, allow_stdin)
             method = CELL_MAGIC.get(magic[2:])
             if not method:
                 self.error(f"Cell magic {magic} not defined")
             else:
-                res = method[0](self, args, code)
+                with self.cell_scope():
+                    if magic == '%%connect':
+                        # timed by execute_cell and _execute_line_magic
+                        res = method[0](self, args, code)
+                    else:
+                        with self.stats.timer(self._stats_name(), 'magic'):
+                            res = method[0](self, args, code)
                 if res: return res
         # error handling is a mess ... could this be moved lower down?
         except StopDoExecute:
             pass
         except KeyboardInterrupt:
             self.error('Interrupted')
-            with self.device as repl:
-                repl.abort()
-        except (SerialException, ConnectionResetError, ConnectionRefusedError) as e:
+            try:
+                with self.repl_session as repl:
+                    repl.abort()
+            except Exception as e:
+                # e.g. device busy with a job, connection lost
+                self.error(f"Cannot abort: {e}", end="")
+        except _serial_errors() as e:
             # no exclusive access (serial) or connection reset (network)
             self.error(f"{self.device.name}: {e}", end="")
-        except WebSocketException as e:
+        except _websocket_errors() as e:
             self.error(f"Webrepl: {e}")
         except TimeoutError:
             self.error(f"Timeout connecting to {self.device.name} @ {self.device.url}")
@@ -106,6 +222,11 @@ class IoTKernel(IPythonKernel):
             self.print("\n\nDetails:\n")
             self.exception(ex, display_trace=True)
             time.sleep(0.5)
+        finally:
+            self.__output.flush(final=True)
+            if self.__tail:
+                self.__tail.flush(final=True)
+                self.__tail = None
         return {'status': 'ok',
                 # The base class increments the execution count
                 'execution_count': self.execution_count,
@@ -117,6 +238,7 @@ class IoTKernel(IPythonKernel):
     def execute_cell(self, code):
         # evaluate cell - code on MCU, magics in IoT Kernel
         # called from %%connect
+        counted = False
         while code:
             code = code.strip()
             if code.startswith('%') or code.startswith('!'):
@@ -127,8 +249,13 @@ class IoTKernel(IPythonKernel):
             else:
                 # eval on mcu ...
                 idx = min((code+'\n%').find('\n%'), (code+'\n!').find('\n!'))
-                with self.device as repl:
-                    repl.exec(code[:idx], data_consumer=self.data_consumer, timeout=1000000000)
+                name = self._stats_name(self.device)
+                if not counted:
+                    self.stats.add(name, 'cells')
+                    counted = True
+                with self.repl_session as repl:
+                    with self.stats.timer(name, 'exec'):
+                        repl.exec(code[:idx], data_consumer=self.data_consumer, timeout=1000000000)
                     code = code[idx:]
 
     def _execute_line_magic(self, line):
@@ -138,7 +265,7 @@ class IoTKernel(IPythonKernel):
                 for line in iter(process.stdout.readline, b''):
                     self.print(line.rstrip().decode('utf-8'))
             return
-        m = re.match(r'%([^ ]*)( .*)?', line)
+        m = _LINE_MAGIC_RE.match(line)
         if not m:
             self.error(f"Syntax error: '{line.encode()}'\n")
             return
@@ -148,38 +275,96 @@ class IoTKernel(IPythonKernel):
         method = LINE_MAGIC.get(name)
         logger.debug(f"line_magic name={name} rest={rest} method={name}")
         if method:
-            method[0](self, rest)
+            with self.stats.timer(self._stats_name(), 'magic'):
+                method[0](self, rest)
         else:
             self.error(f"Line magic {name} not defined")
 
     def data_consumer(self, data:bytes):
         if not data or self.silent: return
+        output = self._output()
         if isinstance(data, bytes):
-            try:
-                data = data.decode()
-            except UnicodeDecodeError:
-                pass
+            # multibyte characters may be split across chunks
+            data = output.decode(data)
         data = str(data)
         # Remove '\r' - output on mac at least comes garbled otherwise
         # Probably because \r\n don't always arrive from micropython in same bytes object
         data = data.replace('\r', '')
         data = data.replace('\x04', '')
-        if data: self.print(data, end='')
+        if data:
+            self.stats.add(self._stats_name(), 'output', len(data))
+            (self._view() or output).write('stdout', data)
 
     def print(self, text="", *color, end='\n'):
         if len(color) > 0 and len(text.strip()) > 0:
             text = colored(str(text), *color)
         if end: text += end
         if not len(text): return
-        stream_content = {'name': 'stdout', 'text': text}
-        self.send_response(self.iopub_socket, 'stream', stream_content)
+        self.write('stdout', text)
 
     def error(self, text="", *color, end='\n'):
         text = str(text)
         if not len(text.strip()): return
         text = colored(str(text), *color)
         if end: text += end
-        stream_content = {'name': 'stderr', 'text': text}
+        self.write('stderr', text)
+
+    def write(self, name, text):
+        # send text to stream name ('stdout' or 'stderr'), or capture it
+        self._output().write(name, text)
+
+    def flush(self):
+        self._output().flush()
+
+    def _stats_name(self, dev=None):
+        # name of (current) device for statistics, without connecting
+        dev = dev or getattr(self.__local, 'device', None) or self.__device
+        if not dev: return HOST
+        name = self.__names.get(dev)
+        if name is None:
+            name = self.__names[dev] = dev.name
+        return name
+
+    def _output(self):
+        return getattr(self.__local, 'output', None) or self.__output
+
+    def _view(self):
+        # receiver of device output other than the notebook, e.g. %output tail, %%stream
+        view = getattr(self.__local, 'view', None)
+        if view: return view
+        if getattr(self.__local, 'device', None):
+            return getattr(self.__local, 'tail', None)
+        if not self.output_tail: return None
+        if not self.__tail:
+            self.__tail = self.tail_view(self.get_parent())
+        return self.__tail
+
+    @contextmanager
+    def output_view(self, view):
+        """Pass device output in the current thread to view.write(name, text)"""
+        previous = getattr(self.__local, 'view', None)
+        self.__local.view = view
+        try:
+            yield
+        finally:
+            self.__local.view = previous
+
+    def tail_view(self, parent):
+        """TailView for output of cell with header parent, None if not enabled"""
+        if not self.output_tail: return None
+        lines, interval = self.output_tail
+        self.__tail_count += 1
+        send = lambda msg_type, content: self.send_iopub(msg_type, content, parent)
+        return TailView(send, lines, interval, f"iot49-tail-{self.__tail_count}")
+
+    def send_iopub(self, msg_type, content, parent=None):
+        """Send iopub message on behalf of the cell with header parent (default: current cell).
+        Unlike send_response, may be called from other threads after the cell has ended."""
+        if parent is None: parent = self.get_parent()
+        self.session.send(self.iopub_socket, msg_type, content, parent)
+
+    def _send_stream(self, name, text):
+        stream_content = {'name': name, 'text': text}
         self.send_response(self.iopub_socket, 'stream', stream_content)
 
     def stop(self, text=""):
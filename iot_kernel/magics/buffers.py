@@ -0,0 +1,328 @@
+from .magic import line_magic, arg
+from iot_device import RemoteError
+from iot_device.pyboard import PyboardError
+
+import binascii, re, sys, time
+
+# %pull, %push
+
+"""Binary transfer of buffers (bytes, bytearray, array.array) between
+microcontroller and host namespace.
+
+The device prints a header line
+
+    @iot49-buf@ typecode itemsize length kind byteorder
+
+followed by the contents, base64 encoded without line breaks, i.e. exactly
+4*ceil(itemsize*length/3) characters. Since the size is known, the host
+reads the payload in large blocks rather than through the byte by byte
+output loop of the raw repl. Uploads are chunked, each chunk decoded on
+the device into a preallocated bytearray.
+"""
+
+_MARK = b'@iot49-buf@'
+
+# raw bytes per chunk, multiple of 3 (base64) and of all item sizes
+_CHUNK = 3 * 1024
+
+_IMPORT = """
+try:
+    from ubinascii import b2a_base64 as _e, a2b_base64 as _d
+except ImportError:
+    from binascii import b2a_base64 as _e, a2b_base64 as _d
+import sys
+"""
+
+_PULL = _IMPORT + """
+def _iot49_pull(v):
+    import array, struct
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        tc, k = 'B', type(v).__name__
+    elif isinstance(v, array.array):
+        tc, k = getattr(v, 'typecode', None) or repr(v[:0])[7], 'array'
+    else:
+        raise TypeError("{{}} does not support the buffer protocol".format(type(v).__name__))
+    sz = struct.calcsize(tc)
+    n = len(v)
+    print('{}', tc, sz, n, k, sys.byteorder)
+    m = memoryview(v)
+    step = {} // sz
+    for i in range(0, n, step):
+        print(_e(m[i:i+step])[:-1].decode(), end='')
+try:
+    _iot49_pull({})
+finally:
+    del _iot49_pull, _e, _d
+"""
+
+_PUSH = _IMPORT + """
+_b = bytearray({})
+_m = memoryview(_b)
+_i = 0
+def _w(s):
+    global _i
+    d = _d(s)
+    _m[_i:_i+len(d)] = d
+    _i += len(d)
+print(sys.byteorder)
+"""
+
+_PUSH_END = """
+try:
+    import array
+    {0} = array.array('{1}')
+    {0}.frombytes(_b)
+except AttributeError:
+    # MicroPython: construct from raw bytes
+    {0} = array.array('{1}', _b)
+del _b, _m, _i, _w, _e, _d
+"""
+
+# numpy dtype kind & itemsize <--> (MicroPython) array typecode
+_TYPECODES = {
+    ('i', 1): 'b', ('u', 1): 'B', ('i', 2): 'h', ('u', 2): 'H', ('i', 4): 'i', ('u', 4): 'I',
+    ('i', 8): 'q', ('u', 8): 'Q', ('f', 4): 'f', ('f', 8): 'd', ('b', 1): 'B',
+}
+
+
+def _kind(typecode):
+    return 'f' if typecode in 'fd' else 'u' if typecode.isupper() else 'i'
+
+
+def _host_array(typecode, itemsize, data, byteorder):
+    # array.array with the same item type as the device's, None if not available
+    import array
+    for tc in 'bBhHiIlLqQfd':
+        if _kind(tc) == _kind(typecode) and array.array(tc).itemsize == itemsize:
+            a = array.array(tc)
+            a.frombytes(data)
+            if byteorder != sys.byteorder and itemsize > 1: a.byteswap()
+            return a
+    return None
+
+
+def _exec_bulk(repl, code, consumer, timeout=10):
+    # Run code that prints a header line and a payload of known size (see above).
+    # consumer(header: bytes) returns the payload size, consumer(data) receives the payload.
+    # timeout: seconds without data from the device
+    pyboard = getattr(repl, 'pyboard', None)
+    if pyboard is None:
+        # no access to the raw repl (other Eval implementation): regular exec
+        out = repl.exec(code)
+        header, _, payload = out.partition(b'\n')
+        consumer(header)
+        consumer(payload.strip())
+        return
+    # errors like ReplProtocol.exec
+    try:
+        _read_bulk(pyboard, code, consumer, timeout)
+    except OSError:
+        raise RemoteError("Device disconnected")
+    except PyboardError as e:
+        raise RemoteError(*e.args)
+
+
+def _read_bulk(pyboard, code, consumer, timeout):
+    pyboard.exec_raw_no_follow(code)
+    device = pyboard.serial
+    deadline = time.monotonic() + timeout
+    def read(n):
+        nonlocal deadline
+        data = device.read(n)
+        if data:
+            deadline = time.monotonic() + timeout
+        elif time.monotonic() > deadline:
+            raise RemoteError(f"timeout: no response from device for {timeout}s")
+        return data
+    def error(rest):
+        # end of output (\x04) reached early, rest: data read after it (start of the traceback)
+        end = rest.find(b'\x04')
+        if end < 0:
+            rest += pyboard.read_until(1, b'\x04', timeout=timeout)
+            end = rest.find(b'\x04')
+        elif rest[end+1:]:
+            # the prompt (>) has been read, too: re-enter the raw repl for the next exec
+            pyboard.enter_raw_repl(soft_reset=False)
+        err = rest[:end] if end >= 0 else rest
+        raise RemoteError(err.decode(errors='replace') or "unexpected end of output")
+    # header, byte by byte
+    header = bytearray()
+    while not header.endswith(b'\n'):
+        c = read(1)
+        if c == b'\x04': error(b'')
+        header.extend(c)
+    size = consumer(bytes(header))
+    # payload, in blocks: the end of output (\x04, errors, \x04, >) is left to follow
+    # \x04 is not in the base64 alphabet: in the payload it means the device raised an exception
+    while size > 0:
+        data = read(min(size, 16384))
+        end = data.find(b'\x04')
+        if end >= 0: error(data[end+1:])
+        if data:
+            consumer(data)
+            size -= len(data)
+    _, err = pyboard.follow(timeout=timeout)
+    if err: raise RemoteError(err.decode(errors='replace'))
+
+
+class _Receiver:
+    """Parses header and decodes payload of a pull"""
+
+    def __init__(self):
+        self.header = None
+        self.buffer = None
+        self._pos = 0
+        self._rest = b''
+
+    def __call__(self, data):
+        if self.header is None:
+            fields = data.strip().split()
+            if len(fields) != 6 or fields[0] != _MARK:
+                # not RemoteError: the raw repl is in an unknown state, Session closes it
+                raise ValueError(f"unexpected response: {data[:80]}")
+            tc, sz, n, kind, byteorder = [ f.decode() for f in fields[1:] ]
+            self.header = (tc, int(sz), int(n), kind, byteorder)
+            self.buffer = bytearray(int(sz) * int(n))
+            return 4 * ((len(self.buffer) + 2) // 3)
+        data = self._rest + data
+        k = len(data) - len(data) % 4
+        self._rest = data[k:]
+        if k:
+            decoded = binascii.a2b_base64(data[:k])
+            self.buffer[self._pos:self._pos+len(decoded)] = decoded
+            self._pos += len(decoded)
+
+    def value(self, use_numpy=True):
+        """bytes, bytearray, numpy array or array.array"""
+        tc, sz, n, kind, byteorder = self.header
+        if self._pos != len(self.buffer):
+            raise RemoteError(f"incomplete transfer: {self._pos} of {len(self.buffer)} bytes")
+        if kind == 'bytes' or kind == 'memoryview':
+            return bytes(self.buffer)
+        if kind == 'bytearray':
+            return self.buffer
+        if use_numpy:
+            try:
+                import numpy as np
+                order = '<' if byteorder == 'little' else '>'
+                return np.frombuffer(self.buffer, dtype=f"{order}{_kind(tc)}{sz}")
+            except ImportError:
+                pass
+        a = _host_array(tc, sz, self.buffer, byteorder)
+        return bytes(self.buffer) if a is None else a
+
+
+def _describe(value):
+    t = type(value)
+    if t.__module__ == 'numpy':
+        return f"numpy {value.dtype} array, {value.size} items"
+    if t.__name__ == 'array':
+        return f"array('{value.typecode}'), {len(value)} items"
+    return f"{t.__name__}, {len(value)} bytes"
+
+
+def _identifier(kernel, name):
+    if not re.fullmatch(r'[A-Za-z_]\w*', name):
+        kernel.stop(f"'{name}' is not a valid variable name")
+    return name
+
+
+@arg('-q', '--quiet', action='store_true', help="no output (except errors)")
+@arg('--bytes', action='store_true', help="arrays as bytes (no conversion to numpy or array)")
+@arg('target', nargs='?', help="host variable name (default: same as source)")
+@arg('source', help="variable (or expression) on the microcontroller")
+@line_magic
+def pull_magic(kernel, args):
+    """Copy a buffer from the microcontroller to the host namespace
+The value (bytes, bytearray, memoryview or array.array) is transferred
+in binary (base64) form. Arrays arrive as numpy arrays if numpy is
+installed, else as array.array (or bytes if there is no array type with
+the same item size on the host).
+
+Examples:
+    %pull samples                # device samples --> host samples
+    %pull adc.buf adc_buf        # expression on device, host name
+    """
+    target = _identifier(kernel, args.target or args.source)
+    receiver = _Receiver()
+    start = time.monotonic()
+    with kernel.repl_session as repl:
+        _exec_bulk(repl, _PULL.format(_MARK.decode(), _CHUNK, args.source), receiver)
+    value = receiver.value(not args.bytes)
+    if args.bytes and not isinstance(value, (bytes, bytearray)):
+        value = bytes(receiver.buffer)
+    kernel.shell.user_ns[target] = value
+    if not args.quiet:
+        _summary(kernel, 'pulled', target, value, len(receiver.buffer), time.monotonic() - start)
+
+
+@arg('-q', '--quiet', action='store_true', help="no output (except errors)")
+@arg('target', nargs='?', help="variable name on the microcontroller (default: same as source)")
+@arg('source', help="host variable (bytes, bytearray, array.array or numpy array)")
+@line_magic
+def push_magic(kernel, args):
+    """Copy a buffer from the host namespace to the microcontroller
+bytes and bytearray arrive as such, numpy and array.array arrays as
+array.array with the same item type. Multi-dimensional numpy arrays are
+flattened.
+
+Examples:
+    %push waveform               # host waveform --> device waveform
+    %push table lut              # host table --> device lut
+    """
+    target = _identifier(kernel, args.target or args.source)
+    try:
+        value = kernel.shell.user_ns[args.source]
+    except KeyError:
+        kernel.stop(f"No variable '{args.source}' on host")
+    typecode, data, itemsize = _encode(kernel, value)
+    start = time.monotonic()
+    with kernel.repl_session as repl:
+        byteorder = repl.exec(_PUSH.format(len(data))).decode().strip()
+        if byteorder != sys.byteorder and itemsize > 1:
+            data = _byteswap(data, itemsize)
+        for i in range(0, len(data), _CHUNK):
+            repl.exec(f"_w({binascii.b2a_base64(data[i:i+_CHUNK], newline=False)!r})")
+        if typecode is None:
+            kind = type(value).__name__
+            repl.exec(f"{target} = {'_b' if kind == 'bytearray' else 'bytes(_b)'}\ndel _b, _m, _i, _w, _e, _d")
+        else:
+            repl.exec(_PUSH_END.format(target, typecode))
+    if not args.quiet:
+        _summary(kernel, 'pushed', target, value, len(data), time.monotonic() - start)
+
+
+def _encode(kernel, value):
+    # returns typecode (None for bytes, bytearray), data (bytes), itemsize
+    if isinstance(value, (bytes, bytearray)):
+        return None, bytes(value), 1
+    if isinstance(value, memoryview):
+        return None, value.tobytes(), 1
+    t = type(value)
+    if t.__module__ == 'numpy' and t.__name__ == 'ndarray':
+        tc = _TYPECODES.get((value.dtype.kind, value.dtype.itemsize))
+        if tc is None:
+            kernel.stop(f"Cannot push numpy arrays of type {value.dtype}")
+        # little endian on the wire (swapped later if the device is big endian)
+        data = value.astype(value.dtype.newbyteorder('<'), copy=False).tobytes()
+        return tc, data, value.dtype.itemsize
+    if t.__module__ == 'array' and t.__name__ == 'array':
+        if value.typecode not in 'bBhHiIlLqQfd':
+            kernel.stop(f"Cannot push arrays of type '{value.typecode}'")
+        tc = _TYPECODES.get((_kind(value.typecode), value.itemsize))
+        data = value.tobytes() if sys.byteorder == 'little' else _byteswap(value.tobytes(), value.itemsize)
+        return tc, data, value.itemsize
+    kernel.stop(f"Cannot push {t.__name__}, need bytes, bytearray, array.array or numpy array")
+
+
+def _byteswap(data, itemsize):
+    import array
+    tc = { 2: 'H', 4: 'I', 8: 'Q' }[itemsize]
+    a = array.array(tc)
+    a.frombytes(data)
+    a.byteswap()
+    return a.tobytes()
+
+
+def _summary(kernel, verb, name, value, size, elapsed):
+    kernel.print(f"{verb} {name}: {_describe(value)} in {elapsed:.2f}s ({size/1024/max(elapsed, 1e-6):.1f} kB/s)")
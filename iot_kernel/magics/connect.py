@@ -1,6 +1,6 @@
 from .magic import line_magic, cell_magic, arg
 
-# %connect, %%connect
+# %connect, %%connect, %session, %jobs, %kill
 
 @arg('-q', '--quiet', action='store_true', help="no output (except errors)")
 @arg('schemes', nargs='*', default=None, help="connection scheme")
@@ -32,7 +32,13 @@ Examples:
     %connect 'serial:///dev/cu.usbserial-0160B5B8'
     # connect to a device via the mp protocol
     %connect 'mp://10.39.40.135:8266'
+    # replay a recording (see %record), 10 times faster than recorded
+    %connect 'replay://session.rec?speed=10'
     """
+    from ..recorder import SCHEME
+    if args.hostname.startswith(f"{SCHEME}://"):
+        _connect_replay(kernel, args)
+        return
     dev = kernel.device_registry.get_device(args.hostname, schemes=args.schemes)
     if dev:
         kernel.device = dev
@@ -43,12 +49,64 @@ Examples:
         kernel.stop(f"Device not available: '{args.hostname}'")
 
 
+def _connect_replay(kernel, args):
+    # replay devices are not registered (and not remembered as default device)
+    from ..recorder import ReplayDevice
+    try:
+        dev = ReplayDevice(args.hostname)
+    except (OSError, ValueError, KeyError) as e:
+        kernel.stop(f"Cannot replay '{args.hostname}': {e}")
+    kernel.device = dev
+    if not args.quiet:
+        kernel.print(f"Connected to {dev.name} @ {dev.url} (replay, recorded {dev.header.get('time')})", 'grey', 'on_cyan')
+
+
+@arg('-c', '--close', action='store_true', help="close all open sessions")
+@arg('-i', '--idle', type=float, default=None, metavar="SECONDS", help="keep sessions open for SECONDS after a cell ends")
+@line_magic
+def session_magic(kernel, args):
+    """Show or configure raw repl sessions
+A session (connection and raw repl) is opened on first use in a cell and
+reused by all code and magics in the cell. By default it is closed when
+the cell ends, releasing the device for other programs. With --idle the
+session is kept open for the given number of seconds, saving the
+handshake for cells that follow in quick succession.
+
+Examples:
+    %session              # list open sessions
+    %session --idle 30    # keep sessions open for 30 seconds after each cell
+    %session --idle 0     # close sessions at the end of each cell (default)
+    %session --close      # close all sessions now
+    """
+    if args.idle is not None:
+        kernel.session_idle_timeout = args.idle
+    if args.close:
+        for session in kernel.repl_sessions:
+            session.close()
+    if args.idle is None and not args.close:
+        kernel.print(f"idle timeout: {kernel.session_idle_timeout}s")
+        for session in kernel.repl_sessions:
+            if session.is_open:
+                kernel.print(f"  {session.device.name} @ {session.device.url}")
+
+
 @arg("-q", "--quiet", action="store_true", help="suppress terminal output")
+@arg("-b", "--background", action="store_true", help="run as background job, see %jobs")
+@arg("-p", "--parallel", type=int, default=0, metavar="N", help="run code on up to N devices concurrently")
 @arg("--all", action="store_true", help="run code on all connected microcontrollers")
 @arg('names', nargs='*', help="microcontroller names or UIDs")
 @cell_magic
 def connect_magic(kernel, args, code):
-    """Generalization of %connect to run code on several devices sequentially
+    """Generalization of %connect to run code on several devices
+Devices are visited sequentially unless --parallel is specified.
+In parallel mode output is buffered per device and shown once the device
+is done, followed by a summary of execution time and status.
+
+With --background the cell runs as a job (one per device) and the kernel
+is free to execute other cells, e.g. on the host or other devices. Output
+of the job appears in the cell that started it. List jobs with %jobs,
+stop them with %kill.
+
 Examples:
 
   %%connect --host --all
@@ -59,6 +117,16 @@ Examples:
   %%connect mcu1 mcu2
   # evaluate on named devics mcu1, mcu2
   print('hello world')
+
+  %%connect --all --parallel 8
+  # evaluate on all devices, at most 8 at a time
+  print('hello world')
+
+  %%connect --background
+  # log sensor readings while the notebook remains usable
+  while True:
+      print(sensor.read())
+      time.sleep(1)
     """
     from .. import StopDoExecute
     def show(hostname):
@@ -66,27 +134,127 @@ Examples:
         if not args.quiet:
             kernel.print(f"\n----- {hostname}\n", 'grey', 'on_cyan')
     if len(code) == 0: return
+    if not (args.all or len(args.names) > 0):
+        # execute on currently connected device
+        if args.background:
+            _run_background(kernel, [kernel.device], code, args.quiet)
+        else:
+            kernel.execute_cell(code)
+        return
     if args.all:
-        for d in kernel.device_registry.devices:
-            kernel.device = d
+        devices = list(kernel.device_registry.devices)
+    else:
+        devices = []
+        for hostname in args.names:
+            dev = kernel.device_registry.get_device(hostname)
+            if dev:
+                devices.append(dev)
+            else:
+                kernel.error(f"No such device: {hostname}")
+    if args.background:
+        _run_background(kernel, devices, code, args.quiet)
+        return
+    if args.parallel > 0:
+        _run_parallel(kernel, devices, code, args.parallel, show)
+        return
+    for dev in devices:
+        kernel.device = dev
+        try:
+            show(dev.name)
+            kernel.execute_cell(code)
+        except StopDoExecute:
+            pass
+
+
+def _run_parallel(kernel, devices, code, max_workers, show):
+    # run code on devices in a pool of threads, output is collected per device
+    from .. import StopDoExecute
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    import time
+
+    def run(dev):
+        output = []
+        status = 'ok'
+        start = time.monotonic()
+        with kernel.device_context(dev, lambda name, text: output.append((name, text))):
             try:
-                show(d.name)
                 kernel.execute_cell(code)
             except StopDoExecute:
-                pass
-    else:
-        if len(args.names) > 0:
-            for hostname in args.names:
-                try:
-                    dev = kernel.device_registry.get_device(hostname)
-                    if not dev:
-                        kernel.error(f"No such device: {hostname}")
-                        continue
-                    kernel.device = dev
-                    show(dev.name)
-                    kernel.execute_cell(code)
-                except StopDoExecute:
-                    pass
+                status = 'error'
+            except Exception as e:
+                # e.g. SerialException, WebSocketException, RemoteError
+                kernel.error(f"{dev.name}: {type(e).__name__}: {e}")
+                status = 'error'
+        return output, time.monotonic() - start, status
+
+    if not devices: return
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as pool:
+        futures = { pool.submit(run, dev): dev for dev in devices }
+        for future in as_completed(futures):
+            dev = futures[future]
+            output, elapsed, status = future.result()
+            results[dev] = (elapsed, status)
+            show(dev.name)
+            for name, text in output:
+                kernel.write(name, text)
+
+    # summary
+    kernel.print("")
+    n_width = max(len(dev.name) for dev in devices)
+    for dev in devices:
+        elapsed, status = results[dev]
+        kernel.print(f"{dev.name:{n_width}}  {elapsed:8.3f}s  {status}",
+            'green' if status == 'ok' else 'red')
+
+
+def _run_background(kernel, devices, code, quiet):
+    for dev in devices:
+        job = kernel.jobs.start(dev, code)
+        if not quiet:
+            kernel.print(f"Started job {job.id} on {dev.name}")
+
+
+@arg('-c', '--clear', action='store_true', help="remove finished jobs from the list")
+@line_magic
+def jobs_magic(kernel, args):
+    """List background jobs started with %%connect --background
+
+Example:
+    %jobs
+    """
+    if args.clear:
+        kernel.jobs.clear()
+        return
+    jobs = list(kernel.jobs)
+    if not jobs:
+        kernel.print("no jobs")
+        return
+    n_width = max(len(job.device.name) for job in jobs)
+    for job in jobs:
+        line = job.code.strip().split('\n', 1)[0]
+        if len(line) > 40: line = line[:37] + '...'
+        kernel.print(f"{job.id:4}  {job.device.name:{n_width}}  {job.status:8}  {job.elapsed:8.1f}s  {line}",
+            'green' if job.status in ('running', 'done') else 'red')
+
+
+@arg('--all', action='store_true', help="kill all running jobs")
+@arg('ids', nargs='*', type=int, help="job ids")
+@line_magic
+def kill_magic(kernel, args):
+    """Stop background jobs
+Interrupts the code running on the device (ctrl-C).
+
+Examples:
+    %kill 2
+    %kill --all
+    """
+    jobs = [ job for job in kernel.jobs if job.is_running ] if args.all else []
+    for id in args.ids:
+        job = kernel.jobs.get(id)
+        if job:
+            jobs.append(job)
         else:
-            # execute on currently connected device
-            kernel.execute_cell(code)
+            kernel.error(f"No such job: {id}")
+    for job in jobs:
+        job.kill()
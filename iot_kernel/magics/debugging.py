@@ -1,10 +1,11 @@
 from .magic import line_magic, cell_magic, arg, CELL_MAGIC, LINE_MAGIC
 from ..kernel_logger import logger
 
+import json
 import logging
 import os
 
-# %loglevel, %kernel
+# %loglevel, %kernel, %stats, %record
 
 
 @arg('level', nargs='?', default='INFO', const='INFO', choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="logging levels")
@@ -46,3 +47,95 @@ Example:
 def kernel_magic(kernel, _, code):
     # exec code in kernel contect. Debugging only.
     exec(code)
+
+
+@arg('-t', '--transport', choices=['on', 'off'], help="count bytes sent and received (default: off)")
+@arg('-j', '--json', metavar="FILE", help="write cumulative and previous cell statistics to FILE (json)")
+@arg('-r', '--reset', action='store_true', help="reset statistics")
+@line_magic
+def stats_magic(kernel, args):
+    """Transport and execution statistics
+Shows, per device, bytes of output, number of raw repl enters, and time
+spent connecting, executing code on the device and in magics, for the
+previous cell and cumulative since the kernel was started or reset.
+
+Bytes sent and received (including raw repl protocol overhead) are
+counted after %stats --transport on. Counting adds a little overhead to
+every read from the device.
+
+Examples:
+    %stats
+    %stats --transport on
+    %stats --json stats.json
+    %stats --reset
+    """
+    from ..stats import FIELDS
+    if args.transport:
+        kernel.stats.transport = args.transport == 'on'
+        # sessions are tapped when opened
+        for session in kernel.repl_sessions:
+            session.close()
+        return
+    if args.reset:
+        kernel.stats.reset()
+        return
+    previous = kernel.stats.previous
+    total = kernel.stats.total
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({ 'previous_cell': previous, 'total': total }, f, indent=2)
+        kernel.print(f"Wrote {args.json}")
+        return
+    if not total:
+        kernel.print("no statistics")
+        return
+    for name in sorted(total):
+        kernel.print(f"{name:30} {'previous cell':>14} {'total':>14}", 'grey', 'on_cyan')
+        for field, (description, fmt) in FIELDS.items():
+            if field in ('sent', 'received') and not (kernel.stats.transport or total[name][field]):
+                continue
+            p = fmt.format(previous.get(name, {}).get(field, 0))
+            t = fmt.format(total[name][field])
+            kernel.print(f"  {description:28} {p:>14} {t:>14}")
+
+
+@arg('-s', '--stop', action='store_true', help="stop recording")
+@arg('file', nargs='?', help="file to record to")
+@line_magic
+def record_magic(kernel, args):
+    """Record the byte stream between kernel and device
+Captures all data sent to and received from the current device, with
+timestamps, until stopped. The raw repl session is restarted so that the
+recording is self-contained. Replay with %connect 'replay://FILE', e.g.
+to profile the kernel without a board or reproduce a slow session.
+
+Examples:
+    %record session.rec                         # start recording
+    %record                                     # show status
+    %record --stop
+    %connect 'replay://session.rec'             # original timing
+    %connect 'replay://session.rec?speed=10'    # 10 times faster
+    %connect 'replay://session.rec?speed=0'     # no delays
+    """
+    recorder = kernel.recorder
+    if args.stop:
+        dev = recorder.device
+        if not dev:
+            kernel.error("Not recording")
+            return
+        kernel.repl_session_for(dev).close()
+        r = recorder.stop()
+        kernel.print(f"Recorded {r['sent']} bytes sent, {r['received']} bytes received "
+                     f"in {r['duration']:.1f}s to {r['path']}")
+    elif args.file:
+        if recorder.device:
+            kernel.error(f"Already recording {recorder.device.name} to {recorder.path}")
+            return
+        dev = kernel.device
+        kernel.repl_session_for(dev).close()
+        recorder.start(dev, args.file)
+        kernel.print(f"Recording {dev.name} to {args.file}")
+    elif recorder.device:
+        kernel.print(f"Recording {recorder.device.name} to {recorder.path}")
+    else:
+        kernel.print("Not recording")
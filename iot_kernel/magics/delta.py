@@ -0,0 +1,212 @@
+from .remote import remote_exec
+from ..kernel_logger import logger
+from iot_device import RemoteError
+from functools import lru_cache
+import zlib
+
+"""Block-level delta upload of files that already exist on the microcontroller
+
+The device computes checksums of fixed size blocks of its copy of the
+file. The host searches its version for these blocks (at any offset,
+so insertions do not shift all later blocks out of alignment) and sends
+instructions to copy matching blocks from the old file plus the bytes in
+between. The device writes the result to a temporary file and reports
+its checksum. Only if it matches the host's does the device rename it
+over the original, otherwise the temporary file is removed.
+
+Checksums are crc32 (binascii) or, on ports without it, adler32. The
+host updates the checksum of the window as it slides by one byte
+(rolling checksum), so the search is linear in the file size.
+"""
+
+def block_size(size):
+    """Block size for a file of the given size (about sqrt(size), at least 512)"""
+    bs = 512
+    while bs * bs < size: bs *= 2
+    return bs
+
+
+def signatures(repl, mcu_path, bs):
+    """(kind, [checksum of each full block]) of mcu_path, None if no such file"""
+    result = remote_exec(repl, f"signatures({repr(mcu_path)},{bs})", _delta_func, timeout=30).decode().split()
+    if not result or result[0] == 'none': return None
+    return result[0], [ int(s) for s in result[1:] ]
+
+
+def checksum(kind, data, value=None):
+    if kind == 'crc32':
+        return zlib.crc32(data, value or 0)
+    return zlib.adler32(data, 1 if value is None else value)
+
+
+def delta(data, kind, sums, bs):
+    """Instructions to rebuild data from a file with block checksums sums
+    yields ('c', first_block, count) or ('w', bytes)"""
+    lookup = {}
+    for i, s in enumerate(sums):
+        lookup.setdefault(s, i)
+    find = _find_crc32 if kind == 'crc32' else _find_adler32
+    view = memoryview(data)
+    n = len(data)
+    p = lit = 0
+    copy = None
+    while True:
+        p, i = find(data, bs, lookup, p)
+        if p is None: break
+        if lit < p:
+            if copy:
+                yield copy
+                copy = None
+            yield ('w', bytes(view[lit:p]))
+        if copy and copy[1] + copy[2] == i:
+            copy = ('c', copy[1], copy[2] + 1)
+        else:
+            if copy: yield copy
+            copy = ('c', i, 1)
+        p += bs
+        lit = p
+    if copy: yield copy
+    if lit < n:
+        yield ('w', bytes(view[lit:]))
+
+
+@lru_cache(maxsize=8)
+def _crc32_tables(bs):
+    # crc32 of data[p+1:p+1+bs] = (v >> 8) ^ t[(v ^ data[p+bs]) & 0xff] ^ u[data[p]]
+    # with v = crc32 of data[p:p+bs]; crc32 is linear (GF(2)) in the crc register
+    F = 0xffffffff
+    def register(d, r):
+        return zlib.crc32(d, r ^ F) ^ F
+    c = register(bytes(bs + 1), F) ^ register(bytes(bs), F) ^ 0xff000000
+    t = [ register(bytes([k ^ 0xff]), 0) for k in range(256) ]
+    u = [ register(bytes([x]) + bytes(bs), 0) ^ c for x in range(256) ]
+    return t, u
+
+
+def _find_crc32(data, bs, lookup, p):
+    # first window at or after p whose checksum is in lookup: (offset, block), (None, None) if none
+    n = len(data)
+    if p + bs > n: return None, None
+    t, u = _crc32_tables(bs)
+    v = zlib.crc32(data[p:p+bs])
+    while True:
+        i = lookup.get(v)
+        if i is not None: return p, i
+        if p + bs >= n: return None, None
+        v = (v >> 8) ^ t[(v ^ data[p+bs]) & 0xff] ^ u[data[p]]
+        p += 1
+
+
+def _find_adler32(data, bs, lookup, p):
+    n = len(data)
+    if p + bs > n: return None, None
+    v = zlib.adler32(data[p:p+bs])
+    a, b = v & 0xffff, v >> 16
+    while True:
+        i = lookup.get((b << 16) | a)
+        if i is not None: return p, i
+        if p + bs >= n: return None, None
+        out = data[p]
+        a = (a - out + data[p+bs]) % 65521
+        b = (b - bs * out + a - 1) % 65521
+        p += 1
+
+
+def put_delta(repl, host_path, mcu_path, chunk_size=512):
+    """Upload host_path by sending only blocks that differ from mcu_path
+    Returns number of bytes sent, None if mcu_path does not exist or the
+    result could not be verified (caller falls back to a full upload)."""
+    with open(host_path, 'rb') as f:
+        data = f.read()
+    bs = block_size(len(data))
+    sig = signatures(repl, mcu_path, bs)
+    if sig is None: return None
+    kind, sums = sig
+    sent = 0
+    repl.exec(f"_dx=__iot49k__['DeltaWriter']({repr(mcu_path)},{bs})")
+    try:
+        for op in delta(data, kind, sums, bs):
+            if op[0] == 'c':
+                repl.exec(f"_dx.c({op[1]},{op[2]})")
+            else:
+                lit = op[1]
+                for i in range(0, len(lit), chunk_size):
+                    chunk = lit[i:i+chunk_size]
+                    repl.exec(f"_dx.w({repr(chunk)})")
+                    sent += len(chunk)
+        remote = repl.exec("_dx.close()").decode().strip()
+    except RemoteError:
+        # e.g. file system full: remove the temporary file
+        repl.exec("_dx.abort(); del _dx")
+        raise
+    if remote != str(checksum(kind, data)):
+        repl.exec("_dx.abort(); del _dx")
+        logger.info(f"delta {mcu_path}: checksum mismatch ({remote}), full upload")
+        return None
+    repl.exec("_dx.commit(); del _dx")
+    logger.debug(f"delta {mcu_path}: sent {sent} of {len(data)} bytes")
+    return sent
+
+
+###############################################################################
+# code snippet (runs on remote)
+
+_delta_func = """
+import os
+try:
+    from binascii import crc32 as _ck
+    _CK = 'crc32'
+except ImportError:
+    _CK = 'adler32'
+    def _ck(d, v=1):
+        a = v & 0xffff
+        b = v >> 16
+        for x in d:
+            a = (a + x) % 65521
+            b = (b + a) % 65521
+        return (b << 16) | a
+
+def signatures(path, bs):
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        print('none')
+        return
+    print(_CK, end='')
+    with f:
+        while True:
+            d = f.read(bs)
+            if len(d) < bs: break
+            print('', _ck(d), end='')
+    print()
+
+class DeltaWriter:
+    def __init__(s, path, bs):
+        s.p = path
+        s.t = path + '.~'
+        s.bs = bs
+        s.v = None
+        s.f = open(path, 'rb')
+        s.o = open(s.t, 'wb')
+    def w(s, d):
+        s.o.write(d)
+        s.v = _ck(d) if s.v is None else _ck(d, s.v)
+    def c(s, i, n):
+        s.f.seek(i * s.bs)
+        for _ in range(n):
+            s.w(s.f.read(s.bs))
+    def close(s):
+        s.f.close()
+        s.o.close()
+        print(_ck(b'') if s.v is None else s.v)
+    def commit(s):
+        try:
+            os.rename(s.t, s.p)
+        except OSError:
+            os.remove(s.p)
+            os.rename(s.t, s.p)
+    def abort(s):
+        s.f.close()
+        s.o.close()
+        os.remove(s.t)
+"""
@@ -0,0 +1,102 @@
+from iot_device import Env
+from iot_device.eval_rlist import TZ
+from .host_index import HostIndex
+from .remote import remote_exec
+from ..kernel_logger import logger
+import json, os, tempfile
+
+"""Cached listing of the files on a microcontroller, keyed by device uid
+
+    fingerprint: hash of the device filesystem (paths, sizes, mtimes)
+    files:       mcu_path -> [mtime, size, sha256 or None]
+
+The fingerprint is computed on the device and only a single number
+crosses the link; the full listing (repl.rlist) is needed only when the
+fingerprint differs from the cached one.
+"""
+
+class DeviceManifest:
+
+    def __init__(self, uid):
+        name = uid.replace(':', '').replace('/', '_')
+        self._path = os.path.join(Env.expand_path(HostIndex.ROOT), f"device-{name}.json")
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self._fingerprint = data.get('fingerprint')
+        self._files = data.get('files', {})
+
+    def files(self, fingerprint):
+        """dict mcu_path -> (mtime, size) if fingerprint matches, None otherwise"""
+        if fingerprint is None or fingerprint != self._fingerprint: return None
+        return { k: (v[0], v[1]) for k, v in self._files.items() }
+
+    def checksum(self, mcu_path):
+        entry = self._files.get(mcu_path)
+        return entry[2] if entry and len(entry) > 2 else None
+
+    def store(self, fingerprint, files, checksums={}):
+        """files: mcu_path -> (mtime, size); checksums: mcu_path -> sha256"""
+        self._fingerprint = fingerprint
+        self._files = { k: [v[0], v[1], checksums.get(k, self.checksum(k))] for k, v in files.items() }
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._path), prefix='.tmp.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({ 'fingerprint': fingerprint, 'files': self._files }, f)
+        os.replace(tmp, self._path)
+        logger.debug(f"device manifest: {len(files)} files, fingerprint {fingerprint}")
+
+
+def fingerprint(repl):
+    """Hash of paths, sizes and mtimes of all files on the device, None if not available"""
+    try:
+        return remote_exec(repl, "fingerprint()", _fingerprint_func, timeout=30).decode().strip()
+    except Exception as e:
+        logger.info(f"fingerprint: {e}")
+        return None
+
+
+def stat(repl, paths):
+    """dict mcu_path -> (mtime, size) as reported by the device (size -1 for directories)
+    mtime in the convention of repl.rlist"""
+    if not paths: return {}
+    res = remote_exec(repl, f"stat({repr(list(paths))})", _stat_func, timeout=30).decode().split()
+    result = {}
+    for path, mtime, size in zip(paths, res[0::2], res[1::2]):
+        result[path] = (int(TZ.local2gmtime(int(mtime))), int(size))
+    return result
+
+
+###############################################################################
+# code snippets (run on remote)
+
+_fingerprint_func = """
+import os
+def _fp(p, h):
+    for n in os.listdir(p):
+        if n.startswith('.'): continue
+        f = p + n if p.endswith('/') else p + '/' + n
+        s = os.stat(f)
+        h = ((h * 1000003) ^ hash(f) ^ s[6] ^ s[7]) & 0x3fffffff
+        if s[0] & 0x4000:
+            h = _fp(f, h)
+    return h
+def fingerprint():
+    print(_fp('/', 0), end='')
+"""
+
+_stat_func = """
+import os
+t_off = 0
+try:
+    import machine
+    t_off = 946684800
+except ImportError:
+    pass
+def stat(paths):
+    for p in paths:
+        s = os.stat(p)
+        print(s[7] + t_off, -1 if s[0] & 0x4000 else s[6])
+"""
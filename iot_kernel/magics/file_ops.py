@@ -1,19 +1,33 @@
 from .magic import line_magic, arg
+from .transfer import Transfer
+from .minify import Minifier
 
 from iot_device import RemoteError, Env, cd
+from fnmatch import fnmatch
 import contextlib
+import glob
 import os
 import sys
 
 # %cp, %cat, %rm, %mkdirs
 
 
+@arg('-m', '--minify', action='store_true', help="strip comments, docstrings and whitespace from .py files uploaded")
+@arg('-q', '--quiet', action='store_true', help="no progress display and summary")
+@arg('-r', '--recursive', action='store_true', help="copy directories recursively")
 @arg("destination", help="Name of destination file/directory")
-@arg("sources", nargs="+", help="Names of source files")
+@arg("sources", nargs="+", help="Names of source files, directories (with -r), or glob patterns")
 @line_magic
 def cp_magic(kernel, args):
     """Copy files between host and microcontroller
 File/directory names starting with colon (:) refer to the microcontroller.
+Sources may be glob patterns (e.g. *.py) or, with -r, directories.
+Host files are read while the transfer to the microcontroller is in
+progress. A summary with the transfer rate is printed at the end.
+Large files (8 kB or more) that already exist on the microcontroller
+are updated by sending only the blocks that changed.
+With --minify, comments, docstrings and redundant whitespace are removed
+from .py files before uploading.
 
 CircuitPython: By default, CircuitPython disables writing to the
                microcontroller filesystem. To enable, add the line
@@ -36,8 +50,17 @@ Examples:
     %mkdirs x/y
     %cp a.txt b.txt :x/y/
 
+    # copy all python files and folder lib (with subfolders)
+    %cp -r *.py lib :/
+
     # copy file from microcontroller to host
     %cp :a.txt :b.txt ./
+
+    # copy folder lib from microcontroller to host
+    %cp -r :lib ./
+
+    # upload minified source
+    %cp -m -r lib :/
     """
     # see https://github.com/micropython/micropython/blob/master/tools/pyboard.py
     def fname_remote(src):
@@ -55,34 +78,107 @@ Examples:
             dest += src
         return Env.expand_path(dest)
 
+    def fname_dir_dest(rel, dest):
+        # dest is a directory
+        if dest is None or dest == "":
+            return rel
+        return Env.expand_path(dest.rstrip("/") + "/" + rel)
+
     srcs = args.sources
     dest = args.destination
-    with kernel.device as repl:
-        if srcs[0].startswith("./") or dest.startswith(":"):
-            xfer = repl.fput
-            dest = fname_remote(dest)
-        else:
-            xfer = repl.fget
-        for src in srcs:
-            src = fname_remote(src)
-            dst = fname_cp_dest(src, dest)
-            try:
-                xfer(src, dst, data_consumer=kernel.data_consumer)
-            except RemoteError as e:
-                kernel.error(f"Error in 'cp {src} {dst}'")
-                kernel.stop(f"\n{e}")
-            except FileNotFoundError as e:
-                kernel.stop(f"\n{e}")
-            except Exception as e:
-                kernel.error(f"\ncp: {e}")
-                kernel.stop(f"\n{e}")
+    minifier = Minifier() if args.minify else None
+    with kernel.repl_session as repl:
+        xfer = Transfer(kernel, repl, progress=not args.quiet, transform=minifier)
+        try:
+            if srcs[0].startswith("./") or dest.startswith(":"):
+                dest = fname_remote(dest)
+                files = _host_files(kernel, [ fname_remote(s) for s in srcs ], args.recursive)
+                if len(files) == 1 and not args.recursive:
+                    pairs = [ (files[0][0], fname_cp_dest(files[0][1], dest)) ]
+                else:
+                    pairs = [ (src, fname_dir_dest(rel, dest)) for src, rel in files ]
+                xfer.put(pairs)
+            else:
+                files = _mcu_files(kernel, repl, [ fname_remote(s) for s in srcs ], args.recursive)
+                if len(files) == 1 and not args.recursive:
+                    src, rel, size = files[0]
+                    pairs = [ (src, fname_cp_dest(rel, dest), size) ]
+                else:
+                    pairs = [ (src, fname_dir_dest(rel, dest), size) for src, rel, size in files ]
+                xfer.get(pairs)
+        except RemoteError as e:
+            kernel.error(f"Error in 'cp {xfer.current}'")
+            kernel.stop(f"\n{e}")
+        except FileNotFoundError as e:
+            kernel.stop(f"\n{e}")
+        except Exception as e:
+            kernel.error(f"\ncp: {e}")
+            kernel.stop(f"\n{e}")
+        if not args.quiet:
+            xfer.summary()
+            if minifier:
+                kernel.print(f"minify: saved {minifier.saved()} bytes")
+
+
+def _host_files(kernel, srcs, recursive):
+    # expand globs and (with recursive) directories
+    # returns list of (path, name relative to destination)
+    result = []
+    for src in srcs:
+        paths = sorted(glob.glob(src)) if glob.has_magic(src) else [ src ]
+        for path in paths:
+            if os.path.isdir(path):
+                if not recursive:
+                    kernel.error(f"cp: -r not specified; omitting directory '{path}'")
+                    continue
+                base = os.path.basename(os.path.normpath(path))
+                for root, dirs, files in os.walk(path):
+                    dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                    for f in sorted(files):
+                        if f.startswith('.'): continue
+                        full = os.path.join(root, f)
+                        result.append((full, os.path.join(base, os.path.relpath(full, path))))
+            elif os.path.exists(path):
+                result.append((path, os.path.basename(path)))
+            else:
+                raise FileNotFoundError(f"No such file or directory: '{path}'")
+    return result
+
+
+def _mcu_files(kernel, repl, srcs, recursive):
+    # expand globs and (with recursive) directories on the microcontroller
+    # returns list of (path, name relative to destination, size)
+    result = []
+    for src in srcs:
+        if not (glob.has_magic(src) or recursive):
+            result.append((src, os.path.basename(src), -1))
+            continue
+        parent = os.path.normpath(os.path.dirname(src) or '/')
+        pattern = os.path.basename(src)
+        # listing: path -> (mtime, size), size < 0 for directories
+        listing = repl.rlist(parent)
+        matches = sorted(p for p in listing
+            if p != parent and os.path.dirname(p) == parent and fnmatch(os.path.basename(p), pattern))
+        if not matches:
+            raise FileNotFoundError(f"No such file or directory: ':{src}'")
+        for m in matches:
+            size = listing[m][1]
+            if size >= 0:
+                result.append((m, os.path.basename(m), size))
+            elif not recursive:
+                kernel.error(f"cp: -r not specified; omitting directory ':{m}'")
+            else:
+                for p, (_, size) in sorted(listing.items()):
+                    if size >= 0 and p.startswith(m + '/'):
+                        result.append((p, os.path.relpath(p, parent), size))
+    return result
 
 
 @arg("path", help="path to file")
 @line_magic
 def cat_magic(kernel, args):
     "Output contents of file stored on microcontroller"
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         try:
             repl.cat(args.path, kernel.data_consumer)
             kernel.print('')
@@ -107,7 +203,7 @@ Examples:
     %rm -rf /         # wipe everything, really!
 """
     try:
-        with kernel.device as repl:
+        with kernel.repl_session as repl:
             for p in args.path:
                 repl.rm_rf(p, r=args.recursive, f=args.force)
     except RemoteError as e:
@@ -123,5 +219,5 @@ Example:
     # create /a and subfolder /a/b on microcontroller
     %mkdirs a/b
 """
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         repl.makedirs(args.path)
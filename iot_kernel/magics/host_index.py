@@ -0,0 +1,63 @@
+from iot_device import Env
+from ..kernel_logger import logger
+import hashlib, json, os, tempfile
+
+"""Persistent index of host files for %rsync
+
+    files:  host_path -> [mtime_ns, size, sha256]
+    synced: device uid -> { mcu_path: sha256 of the content last uploaded }
+
+Files are rehashed only when their mtime or size changes.
+"""
+
+class HostIndex:
+
+    ROOT = os.path.join('~', '.iot49_rsync_index')
+
+    def __init__(self, project):
+        self._path = os.path.join(Env.expand_path(HostIndex.ROOT), f"{project}.json")
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self._files = data.get('files', {})
+        self._synced = data.get('synced', {})
+        self._dirty = False
+
+    def hash(self, host_path):
+        """sha256 of file at host_path"""
+        st = os.stat(host_path)
+        entry = self._files.get(host_path)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        h = hashlib.sha256()
+        with open(host_path, 'rb') as f:
+            while True:
+                data = f.read(64*1024)
+                if not data: break
+                h.update(data)
+        digest = h.hexdigest()
+        self._files[host_path] = [st.st_mtime_ns, st.st_size, digest]
+        self._dirty = True
+        return digest
+
+    def synced(self, uid):
+        """dict mcu_path -> sha256 of files uploaded to device uid"""
+        return self._synced.setdefault(uid, {})
+
+    def set_synced(self, uid, mcu_path, digest):
+        self.synced(uid)[mcu_path] = digest
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty: return
+        # forget files that no longer exist
+        self._files = { k: v for k, v in self._files.items() if os.path.exists(k) }
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._path), prefix='.tmp.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({ 'files': self._files, 'synced': self._synced }, f)
+        os.replace(tmp, self._path)
+        self._dirty = False
+        logger.debug(f"host index: saved {len(self._files)} entries to {self._path}")
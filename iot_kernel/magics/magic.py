@@ -1,109 +1,188 @@
 from ..kernel_logger import logger
 
-from iot_device import redirect_stdout_stderr
 from functools import wraps
 from collections import OrderedDict
-from io import StringIO
-import argparse, shlex, sys
+import argparse, copy, importlib, shlex, sys, threading
 
-# dictionaries of handlers name --> (method, descripion)
-LINE_MAGIC = OrderedDict()
-CELL_MAGIC = OrderedDict()
 
+class MagicRegistry(OrderedDict):
+    """Magic name --> (method, description)
 
-# @cell_magic decorator, use last (after all @arg's)
-def cell_magic(fn):
-    # function that is called when invoking the magic
-    @wraps(fn)
-    def wrapped(kernel, line, body):
-        args = None
-        out = StringIO()
-        err = StringIO()
-        with redirect_stdout_stderr(out, err):
-            try:
-                # parse line
-                args = wrapped.parser.parse_args(shlex.split(line))
-            except SystemExit:
-                pass
-        kernel.print(out.getvalue(), end="")
-        kernel.error(err.getvalue(), end="")
-        if args: fn(kernel, args, body)
+    Modules defining magics are imported when one of their magics is first
+    used (or all of them, when the registry is listed). This keeps kernel
+    startup fast and defers importing heavy dependencies (e.g. paramiko).
+    """
+
+    def __init__(self, modules):
+        super().__init__()
+        # magic name --> module (in this package) that defines it
+        self.modules = modules
+
+    def _load(self, name):
+        module = self.modules.get(name)
+        if module and not super().__contains__(name):
+            logger.debug(f"loading magics from {module}")
+            importlib.import_module(f".{module}", __package__)
+
+    def load_all(self):
+        for module in sorted(set(self.modules.values())):
+            importlib.import_module(f".{module}", __package__)
 
+    def get(self, name, default=None):
+        self._load(name)
+        return super().get(name, default)
+
+    def __getitem__(self, name):
+        self._load(name)
+        return super().__getitem__(name)
+
+    def __contains__(self, name):
+        return name in self.modules or super().__contains__(name)
+
+    def keys(self):
+        self.load_all()
+        return super().keys()
+
+    def values(self):
+        self.load_all()
+        return super().values()
+
+    def items(self):
+        self.load_all()
+        return super().items()
+
+
+# dictionaries of handlers name --> (method, descripion)
+LINE_MAGIC = MagicRegistry({
+    'discover': 'discover', 'register': 'discover', 'unregister': 'discover',
+    'connect': 'connect', 'session': 'connect', 'jobs': 'connect', 'kill': 'connect',
+    'softreset': 'mcu', 'hardreset': 'mcu', 'uid': 'mcu', 'name': 'mcu',
+    'info': 'mcu', 'synctime': 'mcu', 'gettime': 'mcu',
+    'rlist': 'rsync', 'rdiff': 'rsync', 'rsync': 'rsync',
+    'deploy': 'deploy',
+    'cp': 'file_ops', 'cat': 'file_ops', 'rm': 'file_ops', 'mkdirs': 'file_ops',
+    'pip': 'pip', 'upip': 'pip',
+    'store': 'store', 'pull': 'buffers', 'push': 'buffers',
+    'cd': 'utilities', 'lsmagic': 'utilities', 'output': 'utilities',
+    'loglevel': 'debugging', 'stats': 'debugging', 'record': 'debugging',
+    'time': 'timing',
+})
+
+CELL_MAGIC = MagicRegistry({
+    'connect': 'connect',
+    'bash': 'bash',
+    'ssh': 'ssh', 'service': 'ssh',
+    'writefile': 'utilities',
+    'kernel': 'debugging',
+    'timeit': 'timing',
+    'stream': 'stream',
+})
+
+
+class _Parser(argparse.ArgumentParser):
+    # collects help & error messages instead of printing them to stdout/stderr
+
+    _messages = threading.local()
+
+    def _print_message(self, message, file=None):
+        if message:
+            stream = 'stdout' if file is sys.stdout else 'stderr'
+            _Parser._messages.list.append((stream, message))
+
+
+def _parser(wrapped, prog, doc):
+    # argparse parser, constructed on first use
+    if wrapped._parser is None:
+        parser = _Parser(
+            prog=prog,
+            description=doc[0],
+            epilog=doc[1],
+            formatter_class=lambda prog: argparse.RawDescriptionHelpFormatter(prog, max_help_position=22, width=80))
+        for args, kwargs in wrapped.args:
+            parser.add_argument(*args, **kwargs)
+        wrapped._parser = parser
+    return wrapped._parser
+
+
+# parse results of recent lines, per magic (callers get deep copies: lists are not shared)
+_PARSE_CACHE_SIZE = 64
+
+def _parse(kernel, wrapped, line):
+    # parse arguments, None if parsing fails or help was printed
+    if wrapped.raw:
+        return argparse.Namespace(line=line)
+    if not line and not wrapped.args:
+        # magic without arguments
+        return argparse.Namespace()
+    args = wrapped._parsed.get(line)
+    if args is not None:
+        return copy.deepcopy(args)
+    _Parser._messages.list = messages = []
+    try:
+        args = wrapped.parser().parse_args(shlex.split(line))
+    except SystemExit:
+        args = None
+    for stream, message in messages:
+        if stream == 'stdout':
+            kernel.print(message, end="")
+        else:
+            kernel.error(message, end="")
+    if args is None: return None
+    if len(wrapped._parsed) >= _PARSE_CACHE_SIZE:
+        wrapped._parsed.clear()
+    wrapped._parsed[line] = args
+    return copy.deepcopy(args)
+
+
+def _magic(fn, wrapped, prefix, registry):
     # extract magic name and docstring
     name = fn.__name__.rsplit('_')[0]
     doc = (fn.__doc__ or "").split('\n', 1)
     if len(doc) < 2: doc.append("")
 
-    # construct the parser
-    wrapped.parser = argparse.ArgumentParser(
-        prog='%%' + name,
-        description=doc[0],
-        epilog=doc[1],
-        formatter_class=lambda prog: argparse.RawDescriptionHelpFormatter(prog, max_help_position=22, width=80))
+    # arguments added by @arg, parser constructed on first call
+    wrapped.args = []
+    wrapped.raw = False
+    wrapped._parser = None
+    wrapped._parsed = {}
+    wrapped.parser = lambda: _parser(wrapped, prefix + name, doc)
 
     # add to dict
-    CELL_MAGIC[name] = (wrapped, doc[0])
+    registry[name] = (wrapped, doc[0])
     return wrapped
 
 
+# @cell_magic decorator, use last (after all @arg's)
+def cell_magic(fn):
+    # function that is called when invoking the magic
+    @wraps(fn)
+    def wrapped(kernel, line, body):
+        args = _parse(kernel, wrapped, line)
+        if args: fn(kernel, args, body)
+    return _magic(fn, wrapped, '%%', CELL_MAGIC)
+
+
 # @line_magic decorator, use last (after all @arg's)
 def line_magic(fn):
     # function that is called when invoking the magic
     @wraps(fn)
     def wrapped(kernel, line):
-        args = None
-        out = StringIO()
-        err = StringIO()
-        with redirect_stdout_stderr(out, err):
-            try:
-                # parse line
-                args = wrapped.parser.parse_args(shlex.split(line))
-            except SystemExit:
-                pass
-        kernel.print(out.getvalue(), end="")
-        kernel.error(err.getvalue(), end="")
+        args = _parse(kernel, wrapped, line)
         if args: fn(kernel, args)
+    return _magic(fn, wrapped, '%', LINE_MAGIC)
 
-    # extract magic name and docstring
-    name = fn.__name__.rsplit('_')[0]
-    doc = (fn.__doc__ or "").split('\n', 1)
-    if len(doc) < 2: doc.append("")
-
-    # construct the parser
-    wrapped.parser = argparse.ArgumentParser(
-        prog='%' + name,
-        description=doc[0],
-        epilog=doc[1],
-        formatter_class=lambda prog: argparse.RawDescriptionHelpFormatter(prog, max_help_position=22, width=80))
-        # formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    # add to dict
-    LINE_MAGIC[name] = (wrapped, doc[0])
+# @raw_line_magic decorator: magic receives the unparsed line in args.line
+def raw_line_magic(fn):
+    wrapped = line_magic(fn)
+    wrapped.raw = True
     return wrapped
 
 
 # @arg decorator (may be repeated)
 def arg(*args, **kwargs):
-    # add argument to the parser that was construction by @line_magic
+    # add argument to the parser that is constructed by @line_magic
     def wrap(fn):
-        fn.parser.add_argument(*args, **kwargs)
+        fn.args.append((args, kwargs))
         return fn
     return wrap
-
-
-# pylint: disable=unused-wildcard-import
-
-from .discover import *
-from .connect import *
-from .mcu import *
-from .rsync import *
-from .file_ops import *
-from .pip import *
-
-from .bash import *
-from .ssh import *
-
-from .store import *
-from .utilities import *
-
-from .debugging import *
@@ -17,7 +17,7 @@ Example:
     %softreset
     print(a)   # NameError: name 'a' isn't defined
 """
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         if not args.quiet:
             kernel.print("")
             kernel.print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!", 'red', 'on_cyan')
@@ -26,6 +26,8 @@ Example:
         repl.softreset()
         if not args.quiet:
             kernel.print("")
+    # network connections do not survive the reset
+    kernel.repl_session.close()
 
 
 @arg("-t", "--timeout", type=float, default=2.5, help="time in seconds to wait for output (default: 2.5)")
@@ -40,13 +42,14 @@ Note: there may be errors (cannot enter raw repl) from subsequent
 Example:
     %hardreset                 
 """
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         kernel.print("")
         kernel.print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!",   'red', 'on_cyan')
         kernel.print("!!!!!   hardreset ...     !!!!!",   'red', 'on_cyan')
         kernel.print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n", 'red', 'on_cyan')
         repl.hardreset(kernel, args.timeout)
         kernel.print("")
+    kernel.repl_session.close()
 
 @line_magic
 def uid_magic(kernel, _):
@@ -86,7 +89,7 @@ def info_magic(kernel, args):
 @line_magic
 def synctime_magic(kernel, _):
     "Synchronize microcontroller time to host"
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         repl.sync_time()
         t = time.mktime(repl.get_time())
         kernel.print(f"{time.strftime('%Y-%b-%d %H:%M:%S', time.localtime(t))}")
@@ -94,6 +97,6 @@ def synctime_magic(kernel, _):
 @line_magic
 def gettime_magic(kernel, _):
     "Query microcontroller time"
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         t = time.mktime(repl.get_time())
         kernel.print(f"{time.strftime('%Y-%b-%d %H:%M:%S', time.localtime(t))}")
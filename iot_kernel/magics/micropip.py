@@ -26,15 +26,15 @@ import sys
 import os
 import errno
 import json
-import zlib
+import shutil
 import tarfile
-import tempfile
+import time
 import ssl as ussl
 import socket as usocket
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 debug = False
 g_install_path = os.getcwd()  # Default install path
-gzdict_sz = 16 + 15
 
 def version():
     print('Python version 3.2 or above is required.')
@@ -48,29 +48,9 @@ elif sys.version_info.major == 3 and sys.version_info.minor < 2:
 class NotFoundError(Exception):
     pass
 
-# Read a line from a socket
-def read_line(sock):
-    ret = b''
-    while True:
-        c = sock.recv(1)
-        if c == b'':
-            break
-        elif c == b'\n':
-            ret += c
-            break
-        else:
-            ret += c
-    return ret
-
-# Read multiple lines from a socket
-def read_lines(sock):
-    s = b''
-    while True:
-        s1 = read_line(sock)
-        s += s1
-        if s1 == b'\r\n' or s1 == b'':
-            break
-    return s
+# Read a line from a buffered socket file
+def read_line(f):
+    return f.readline()
 
 # Expects absolute path and *file* name
 def _makedirs(name):
@@ -124,7 +104,7 @@ def install_tar(f, prefix):
                 _makedirs(outfname)
                 subf = f.extractfile(info)
                 with open(outfname, "wb") as outf:
-                    outf.write(subf.read())
+                    shutil.copyfileobj(subf, outf)
     return meta
 
 warn_ussl = True
@@ -142,6 +122,7 @@ def url_open(url):
         raise
     addr = ai[0][4]
     s = usocket.socket(ai[0][0])
+    f = None
     try:
         if proto == "https:":
             s = ussl.wrap_socket(s)
@@ -151,34 +132,43 @@ def url_open(url):
         s.connect(addr)
         s.setblocking(True)
 
-        s.send(("GET /%s HTTP/1.0\r\nHost: %s\r\n\r\n" % (urlpath, host)).encode('UTF8'))
-        l = read_line(s)
+        s.sendall(("GET /%s HTTP/1.0\r\nHost: %s\r\n\r\n" % (urlpath, host)).encode('UTF8'))
+        # buffered reader, one recv per buffer rather than per byte
+        f = s.makefile('rb')
+        l = read_line(f)
         protover, status, msg = l.split(None, 2)
         if status != b"200":
             if status == b"404" or status == b"301":
                 raise NotFoundError("Package not found")
             raise ValueError(status)
         while 1:
-            l = read_line(s)
+            l = read_line(f)
             if not l:
                 raise ValueError("Unexpected EOF in HTTP headers")
             if l == b'\r\n':
                 break
     except Exception as e:
+        if f: f.close()
         s.close()
         raise e
 
-    return s
+    # the connection stays open until f is closed
+    s.close()
+    return f
 
 # Now searches official library first before looking on PyPi for user packages
-def get_pkg_metadata(name):
+def get_pkg_metadata(name, cache=None):
+    if cache:
+        return cache.metadata(name, fetch_pkg_metadata)
+    return fetch_pkg_metadata(name)
+
+def fetch_pkg_metadata(name):
     try:
         f = url_open("https://micropython.org/pi/%s/json" % name)
     except:
         f = url_open("https://pypi.org/pypi/%s/json" % name)
-    s = read_lines(f)
     try:
-        return json.loads(s.decode('UTF8'))
+        return json.loads(f.read().decode('UTF8'))
     finally:
         f.close()
 
@@ -186,54 +176,85 @@ def fatal(msg):
     print("Error:", msg)
     sys.exit(1)
 
-def install_pkg(pkg_spec, install_path):
-    data = get_pkg_metadata(pkg_spec)
+def install_pkg(pkg_spec, install_path, cache=None):
+    data = get_pkg_metadata(pkg_spec, cache)
 
     latest_ver = data["info"]["version"]
     packages = data["releases"][latest_ver]
     assert len(packages) == 1
     package_url = packages[0]["url"]
+    if cache:
+        sha256 = packages[0].get("digests", {}).get("sha256")
+        path = cache.tarball(pkg_spec, latest_ver, sha256)
+        if path:
+            print("Installing %s %s from cache" % (pkg_spec, latest_ver))
+        elif cache.offline:
+            raise NotFoundError("%s %s not in cache (offline)" % (pkg_spec, latest_ver))
+        else:
+            print("Installing %s %s from %s" % (pkg_spec, latest_ver, package_url))
+            f1 = url_open(package_url)
+            try:
+                path = cache.add_tarball(pkg_spec, latest_ver, f1, sha256)
+            finally:
+                f1.close()
+        with tarfile.open(path, mode="r:gz") as tar_file:
+            return install_tar(tar_file, install_path)
     print("Installing %s %s from %s" % (pkg_spec, latest_ver, package_url))
     f1 = url_open(package_url)
-    s = read_lines(f1)
     try:
-        str1 = zlib.decompress(s, gzdict_sz)
-        with tempfile.TemporaryFile() as temp_file:
-            temp_file.write(str1)
-            temp_file.seek(0)
-            with tarfile.TarFile(fileobj=temp_file) as tar_file:  # Expects a file object
-                meta = install_tar(tar_file, install_path)
+        # decompress and extract while downloading
+        with tarfile.open(fileobj=f1, mode="r|gz") as tar_file:
+            meta = install_tar(tar_file, install_path)
     finally:
         f1.close()
     return meta
 
 
-def install(to_install):
-    install_path = g_install_path
+def install(to_install, install_path=None, cache=None, workers=4):
+    """Install packages and their dependencies.
+    Packages are downloaded and extracted concurrently by a pool of workers;
+    dependencies are queued as soon as the package declaring them is installed.
+    Returns dict pkg_spec -> list of dependencies of installed packages."""
+    install_path = install_path or g_install_path
     install_path = os.path.join(install_path, '')  # Append final /
     if not isinstance(to_install, list):
         to_install = [to_install]
     print("Installing to: " + install_path)
-    # sets would be perfect here, but don't depend on them
-    installed = []
-    try:
-        while to_install:
-            if debug:
-                print("Queue:", to_install)
-            pkg_spec = to_install.pop(0)
-            if pkg_spec in installed:
-                continue
-            meta = install_pkg(pkg_spec, install_path)
-            installed.append(pkg_spec)
-            if debug:
-                print(meta)
-            deps = meta.get("deps", "").rstrip()
-            if deps:
-                deps = deps.decode("utf-8").split("\n")
-                to_install.extend(deps)
-    except Exception as e:
-        print("Error installing '{}': {}, packages may be partially installed".format(
-            pkg_spec, e), file=sys.stderr)
+    start = time.monotonic()
+    resolved = {}
+    seen = set()
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(pkg_spec):
+            pkg_spec = pkg_spec.strip()
+            if not pkg_spec or pkg_spec in seen:
+                return
+            seen.add(pkg_spec)
+            pending[pool.submit(install_pkg, pkg_spec, install_path, cache)] = pkg_spec
+
+        for pkg_spec in to_install:
+            submit(pkg_spec)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pkg_spec = pending.pop(future)
+                try:
+                    meta = future.result()
+                except Exception as e:
+                    print("Error installing '{}': {}, packages may be partially installed".format(
+                        pkg_spec, e), file=sys.stderr)
+                    continue
+                if debug:
+                    print(meta)
+                deps = meta.get("deps", b"").rstrip()
+                deps = deps.decode("utf-8").split("\n") if deps else []
+                resolved[pkg_spec] = deps
+                for dep in deps:
+                    submit(dep)
+    print("Installed %d package(s) in %.2fs:" % (len(resolved), time.monotonic() - start))
+    for pkg_spec, deps in sorted(resolved.items()):
+        print("  %s%s" % (pkg_spec, " -> " + ", ".join(deps) if deps else ""))
+    return resolved
 
 def help_msg():
     print("""\
@@ -0,0 +1,168 @@
+from iot_device import Env
+from ..kernel_logger import logger
+import ast, hashlib, io, keyword, os, tempfile, tokenize
+
+"""Strip docstrings, comments and redundant whitespace from Python source
+
+minify(source) returns equivalent source with
+* comments, docstrings and other string statements removed,
+* one space per indentation level,
+* blank lines and unnecessary blanks between tokens removed,
+* bracketed expressions spanning several lines joined.
+
+If the result does not compile, the original source is returned.
+
+Minifier caches the output on disk, keyed by the sha256 of the source.
+"""
+
+def minify(source:str) -> str:
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return source
+    docstrings = _docstrings(tree)
+    try:
+        result = _minify(source, docstrings)
+        compile(result, '<minify>', 'exec')
+    except (SyntaxError, tokenize.TokenError, IndentationError) as e:
+        logger.info(f"minify: {e}, keeping original")
+        return source
+    return result
+
+
+class Minifier:
+
+    ROOT = os.path.join('~', '.iot49_minify_cache')
+
+    def __init__(self, root=None):
+        self.root = Env.expand_path(root or Minifier.ROOT)
+        # host_path -> (original size, minified size)
+        self.sizes = {}
+
+    def __call__(self, host_path:str, digest:str=None) -> str:
+        """Path of the minified version of host_path (host_path itself if not a .py file)
+        digest: sha256 of host_path if known (e.g. from HostIndex), the file is
+        then read only if it is not in the cache"""
+        if not host_path.endswith('.py'): return host_path
+        source = None
+        if digest is None:
+            with open(host_path, 'rb') as f:
+                source = f.read()
+            digest = hashlib.sha256(source).hexdigest()
+        path = os.path.join(self.root, digest[:2], digest + '.py')
+        if not os.path.exists(path):
+            if source is None:
+                with open(host_path, 'rb') as f:
+                    source = f.read()
+            try:
+                result = minify(source.decode()).encode()
+            except UnicodeDecodeError:
+                result = source
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp.')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(result)
+            os.replace(tmp, path)
+        self.sizes[host_path] = (os.path.getsize(host_path), os.path.getsize(path))
+        return path
+
+    def saved(self, host_paths=None):
+        """Bytes saved for host_paths (default: all files minified so far)"""
+        if host_paths is None: host_paths = self.sizes.keys()
+        return sum(self.sizes[p][0] - self.sizes[p][1] for p in host_paths if p in self.sizes)
+
+
+def _docstrings(tree):
+    # (line, col) of docstrings and other string statements -> True if
+    # a 'pass' must replace it to keep the body from becoming empty
+    result = {}
+    for node in ast.walk(tree):
+        for field in ('body', 'orelse', 'finalbody'):
+            stmts = getattr(node, field, None)
+            if not isinstance(stmts, list) or not stmts or not isinstance(stmts[0], ast.stmt): continue
+            strings = [ s for s in stmts if isinstance(s, ast.Expr) and
+                        isinstance(s.value, ast.Constant) and isinstance(s.value.value, str) ]
+            for i, s in enumerate(strings):
+                result[(s.lineno, s.col_offset)] = i == 0 and len(strings) == len(stmts)
+    return result
+
+
+def _is_word(s):
+    return s[:1].isalnum() or s[:1] == '_'
+
+def _is_word_end(s):
+    return s[-1:].isalnum() or s[-1:] == '_'
+
+
+def _minify(source, docstrings):
+    lines = source.splitlines(keepends=True)
+    out = []
+    line = []           # tokens of current logical line
+    prev = None         # previous token in line
+    indent = 0
+    skip_docstring = False
+    fstring_depth = 0
+    fstring_start = None
+    for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+        typ, s = tok.type, tok.string
+        # python >= 3.12 splits f-strings into several tokens: copy verbatim
+        if typ == getattr(tokenize, 'FSTRING_START', None):
+            if fstring_depth == 0: fstring_start = tok.start
+            fstring_depth += 1
+            continue
+        if fstring_depth:
+            if typ == getattr(tokenize, 'FSTRING_END', None):
+                fstring_depth -= 1
+                if fstring_depth == 0:
+                    s = _slice(lines, fstring_start, tok.end)
+                    typ = tokenize.STRING
+                else:
+                    continue
+            else:
+                continue
+        if typ == tokenize.INDENT:
+            indent += 1
+            continue
+        if typ == tokenize.DEDENT:
+            indent -= 1
+            continue
+        if typ in (tokenize.COMMENT, tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER):
+            continue
+        if typ == tokenize.NEWLINE:
+            if line:
+                out.append(' ' * indent + ''.join(line) + '\n')
+            line = []
+            prev = None
+            skip_docstring = False
+            continue
+        if not line and typ == tokenize.STRING and tok.start in docstrings:
+            if docstrings[tok.start]:
+                # sole statement in body
+                line.append('pass')
+                prev = None
+            skip_docstring = True
+            continue
+        if skip_docstring:
+            # e.g. implicitly concatenated docstring
+            if typ == tokenize.STRING: continue
+            skip_docstring = False
+        if prev is not None and _needs_space(prev, typ, s):
+            line.append(' ')
+        line.append(s)
+        prev = (typ, s)
+    return ''.join(out)
+
+
+def _needs_space(prev, typ, s):
+    ptyp, ps = prev
+    if _is_word_end(ps) and _is_word(s): return True
+    if ptyp == tokenize.NUMBER and (s[:1].isalpha() or s[:1] == '.'): return True
+    if ptyp == tokenize.NAME and keyword.iskeyword(ps) and s[:1] in '."\'': return True
+    if typ == tokenize.NAME and keyword.iskeyword(s) and ps[-1:] in '."\'': return True
+    return False
+
+
+def _slice(lines, start, end):
+    (r0, c0), (r1, c1) = start, end
+    if r0 == r1: return lines[r0-1][c0:c1]
+    return lines[r0-1][c0:] + ''.join(lines[r0:r1-1]) + lines[r1-1][:c1]
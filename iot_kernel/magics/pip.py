@@ -1,26 +1,88 @@
 from .magic import line_magic, arg
-from .micropip import install_pkg as upip_install
+from .pkg_cache import PackageCache
 from iot_device import Env
-import subprocess, shlex, shutil, glob
-import os, sys
-
-def pip_install(kernel, package, target):
-    # use system pip for intallation & perform some cleanup:
-    # ['*.egg-info', '*.dist-info', '__pycache__']
-    # ??? --no-dependencies ???
-    cmd = f"pip install {package} -t {target} --upgrade --no-deps"
+from fnmatch import fnmatch
+import subprocess, shutil, glob, json, re
+import os
+
+# files removed from the target after installation
+PIP_CLEANUP = ['*.egg-info', '*.dist-info', '__pycache__', 'ez_setup.py']
+# record of packages installed in a target directory
+PIP_MANIFEST = '.iot49_pip_manifest.json'
+
+
+def pip_install(kernel, packages, target, upgrade=False):
+    # use system pip for intallation & perform some cleanup
+    # packages already in the manifest are skipped (unless upgrade is True)
+    manifest = _load_manifest(target)
+    todo = []
+    for package in packages:
+        name, version = _split_spec(package)
+        entry = manifest.get(name)
+        if not upgrade and entry and version in (None, entry['version']) and \
+                all(os.path.exists(os.path.join(target, f)) for f in entry['files']):
+            kernel.print(f"{package} {entry['version']} already installed")
+        else:
+            todo.append(package)
+    if not todo: return
+    cmd = [ 'pip', 'install', *todo, '-t', target, '--upgrade', '--no-deps' ]
     # run pip
-    process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, _ = process.communicate()
     kernel.print(f"{stdout.decode().strip()}\n")
     if process.returncode != 0:
-        kernel.error(f"installation of {package} failed")
-    # cleanup
-    for p in ['*.egg-info', '*.dist-info', '__pycache__', 'ez_setup.py']:
-        files = glob.glob(f"{target}/**/{p}", recursive=True)
-        for f in files: shutil.rmtree(f)
+        kernel.error(f"installation of {' '.join(todo)} failed")
+    # record versions & files (from the metadata removed by the cleanup)
+    for dist_info in glob.glob(os.path.join(target, '*.dist-info')):
+        name, version = os.path.basename(dist_info)[:-len('.dist-info')].rsplit('-', 1)
+        manifest[_canonical(name)] = { 'version': version, 'files': _top_level(dist_info) }
+    _cleanup(target)
+    with open(os.path.join(target, PIP_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def _canonical(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def _split_spec(package):
+    # 'name==version' -> (name, version), other specifiers count as unpinned
+    name, _, version = package.partition('==')
+    name = re.split(r"[<>=!~;\[ ]", name, 1)[0]
+    return _canonical(name), (version.strip() or None)
+
+def _load_manifest(target):
+    try:
+        with open(os.path.join(target, PIP_MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _top_level(dist_info):
+    # top level files and directories installed by a package, from RECORD
+    files = set()
+    try:
+        with open(os.path.join(dist_info, 'RECORD')) as f:
+            for line in f:
+                top = line.split(',', 1)[0].split('/', 1)[0]
+                if top and not top.endswith(('.dist-info', '.egg-info')) and top not in ('__pycache__', '..'):
+                    files.add(top)
+    except FileNotFoundError:
+        pass
+    return sorted(files)
 
+def _cleanup(target):
+    # single pass over target, removing files matching PIP_CLEANUP
+    for root, dirs, files in os.walk(target):
+        for d in list(dirs):
+            if any(fnmatch(d, p) for p in PIP_CLEANUP):
+                shutil.rmtree(os.path.join(root, d))
+                dirs.remove(d)
+        for f in files:
+            if any(fnmatch(f, p) for p in PIP_CLEANUP):
+                os.remove(os.path.join(root, f))
 
+
+@arg("-U", "--upgrade", action="store_true", help="reinstall packages that are already installed")
 @arg("-t", "--target", default="libs", help="target directory relative to $IOT_PROJECTS")
 @arg('packages', nargs="+", help="names (on PyPi) of packages to install")
 @arg('operation', help="only supported value is 'install'")
@@ -28,23 +90,31 @@ def pip_install(kernel, package, target):
 def pip_magic(kernel, args):
     """Install packages from PyPi
 The directory is created if it does not exist.
+All packages are installed with a single invocation of pip. Packages that
+were installed previously by %pip are skipped unless a different version
+is requested (e.g. Adafruit-BME280==2.6.4) or --upgrade is given.
 
 Examples:
 
     %pip install adafruit-io Adafruit-BME280
     %pip install -t my_project/code/lib Adafruit-BME280
+    %pip install -U Adafruit-BME280
     """
-    for package in args.packages:
-        target = args.target
-        if not target.startswith(('/', '~')):
-            target = os.path.join(Env.iot_projects(), target)
-        os.makedirs(target, exist_ok=True)
-        pip_install(kernel, package, Env.expand_path(target))
+    target = args.target
+    if not target.startswith(('/', '~')):
+        target = os.path.join(Env.iot_projects(), target)
+    target = Env.expand_path(target)
+    os.makedirs(target, exist_ok=True)
+    pip_install(kernel, args.packages, target, args.upgrade)
 
 
+@arg("--max-size", type=float, default=100, help="prune: cache size limit in MB (default: 100)")
+@arg("--no-cache", action="store_true", help="do not use or update the package cache")
+@arg("--offline", action="store_true", help="install only from the package cache")
+@arg("-j", "--jobs", type=int, default=4, help="number of packages to download concurrently (default: 4)")
 @arg("-t", "--target", default="libs", help="target directory relative to $IOT_PROJECTS")
-@arg('packages', nargs="+", help="names of packages to install")
-@arg('operation', help="only supported value is 'install'")
+@arg('packages', nargs="*", help="names of packages to install")
+@arg('operation', choices=['install', 'prune'], help="install packages or prune the package cache")
 @line_magic
 def upip_magic(kernel, args):
     """Install MicroPython packages
@@ -53,20 +123,40 @@ MicroPython uses a special package format that is not compatible with standard
 (see https://github.com/micropython/micropython-lib/ for available packages).
 If that fails it searches PyPi.
 The directory is created if it does not exist.
+Dependencies are installed also; independent packages are downloaded
+concurrently.
+
+Package metadata (refreshed daily) and tarballs are cached in
+~/.iot49_upip_cache. With --offline packages are installed from the cache
+without network access. `%upip prune` evicts the least recently used
+tarballs until the cache is smaller than --max-size.
 
 Examples:
 
     %upip install micropython-copy micropython-abc
+    %upip install --offline micropython-copy
+    %upip prune --max-size 20
 
 The install is delegated to "micropip.py" described at
 https://github.com/peterhinch/micropython-samples/tree/master/micropip.
     """
+    if args.no_cache and args.offline:
+        kernel.stop("--offline installs from the cache: cannot be combined with --no-cache")
+    cache = None if args.no_cache else PackageCache(offline=args.offline)
+    if args.operation == 'prune':
+        if not cache: kernel.stop("prune: cache disabled (--no-cache)")
+        removed, freed = cache.prune(int(args.max_size * 1024 * 1024))
+        size = sum(e[1] for e in cache.entries())
+        kernel.print(f"removed {removed} files ({freed/1024:.1f} kB), cache size {size/1024:.1f} kB")
+        return
+    if not args.packages:
+        kernel.stop("install: no packages specified")
     target = args.target
     if not target.startswith(('/', '~')):
         target = os.path.join(Env.iot_projects(), target)
     if not target.endswith('/'): target += '/'
     os.makedirs(target, exist_ok=True)
-    for p in args.packages:
-        if not p.startswith('micropython-'):
-            p = 'micropython-' + p
-        upip_install(p, Env.expand_path(target))
+    packages = [ p if p.startswith('micropython-') else 'micropython-' + p for p in args.packages ]
+    # micropip pulls in ssl & tarfile: import on first use
+    from .micropip import install as upip_install
+    upip_install(packages, Env.expand_path(target), cache, args.jobs)
@@ -0,0 +1,108 @@
+from iot_device import Env
+from ..kernel_logger import logger
+import hashlib, json, os, glob, tempfile, time
+
+"""On-disk cache for %upip: package metadata and tarballs
+
+Layout:
+    <root>/meta/<name>.json                          metadata, refreshed after ttl seconds
+    <root>/tar/<name>-<version>-<sha256>.tar.gz     package tarballs
+
+Files are touched when used; prune() evicts least recently used tarballs.
+"""
+
+class CacheMissError(Exception):
+    pass
+
+
+class PackageCache:
+
+    DEFAULT_ROOT = os.path.join('~', '.iot49_upip_cache')
+
+    def __init__(self, root=None, ttl=24*3600, offline=False):
+        self.root = Env.expand_path(root or PackageCache.DEFAULT_ROOT)
+        self.ttl = ttl
+        self.offline = offline
+        os.makedirs(os.path.join(self.root, 'meta'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'tar'), exist_ok=True)
+
+    def metadata(self, name, fetch):
+        """Metadata of package name; fetch(name) is called if the cached copy is missing or expired"""
+        path = os.path.join(self.root, 'meta', f"{name}.json")
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            age = None
+        if age is not None and (self.offline or age < self.ttl):
+            with open(path) as f:
+                return json.load(f)
+        if self.offline:
+            raise CacheMissError(f"{name}: metadata not in cache (offline)")
+        try:
+            data = fetch(name)
+        except OSError as e:
+            if age is None: raise
+            # no network, stale metadata is better than nothing
+            logger.info(f"upip cache: using stale metadata for {name}: {e}")
+            with open(path) as f:
+                return json.load(f)
+        self._write_atomic(path, json.dumps(data).encode())
+        return data
+
+    def tarball(self, name, version, sha256=None):
+        """Path of cached tarball or None"""
+        pattern = f"{name}-{version}-{sha256 or '*'}.tar.gz"
+        for path in glob.glob(os.path.join(self.root, 'tar', pattern)):
+            os.utime(path)
+            return path
+        return None
+
+    def add_tarball(self, name, version, f, sha256=None):
+        """Copy file object f to the cache, verify sha256 (if given) and return the path"""
+        h = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, 'tar'), prefix='.download.')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    data = f.read(64*1024)
+                    if not data: break
+                    h.update(data)
+                    out.write(data)
+            digest = h.hexdigest()
+            if sha256 and sha256 != digest:
+                raise ValueError(f"{name} {version}: sha256 mismatch, expected {sha256}, got {digest}")
+            path = os.path.join(self.root, 'tar', f"{name}-{version}-{digest}.tar.gz")
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return path
+
+    def entries(self):
+        """List of (path, size, last_used) of cached files"""
+        result = []
+        for path in glob.glob(os.path.join(self.root, '*', '*')):
+            st = os.stat(path)
+            result.append((path, st.st_size, st.st_mtime))
+        return result
+
+    def prune(self, max_size):
+        """Evict least recently used tarballs until the cache is at most max_size bytes.
+        Returns number of files removed and bytes freed."""
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        removed = freed = 0
+        for path, size, _ in entries:
+            if total <= max_size: break
+            if not path.endswith('.tar.gz'): continue
+            os.remove(path)
+            total -= size
+            freed += size
+            removed += 1
+        return removed, freed
+
+    def _write_atomic(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
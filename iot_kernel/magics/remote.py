@@ -0,0 +1,21 @@
+from iot_device import RemoteError
+from ..kernel_logger import logger
+
+"""Run helper functions on the microcontroller.
+
+Function definitions are uploaded once per session into the namespace
+__iot49k__ on the device (like iot_device does for its own helpers) and
+re-uploaded automatically after a reset.
+"""
+
+def remote_exec(repl, code:str, func:str, data_consumer=None, timeout=10) -> bytes:
+    """Execute code on remote; upload func (definitions used by code) if required"""
+    try:
+        return repl.exec(f"exec({repr(code)}, __iot49k__)", data_consumer=data_consumer, timeout=timeout)
+    except RemoteError as e:
+        # NameError: definitions missing (first call, or after reset)
+        if 'NameError' not in str(e) and 'KeyError' not in str(e): raise
+        logger.debug(f"remote_exec: upload definitions for {code}")
+        repl.exec("if not '__iot49k__' in globals(): __iot49k__ = {}")
+        repl.exec(f"exec({repr(func)}, __iot49k__)")
+        return repl.exec(f"exec({repr(code)}, __iot49k__)", data_consumer=data_consumer, timeout=timeout)
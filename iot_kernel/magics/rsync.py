@@ -1,23 +1,210 @@
 from .magic import line_magic, arg
-import shlex
+from .host_index import HostIndex
+from .device_manifest import DeviceManifest, fingerprint, stat
+from .transfer import Transfer
+from .minify import Minifier
+from termcolor import colored
+from fnmatch import fnmatch
+from collections import OrderedDict
+from datetime import datetime
+import os, time, threading
 
 
 def _rsync(kernel, args, dry_run):
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         try:
-            repl.rsync(kernel.data_consumer,
-                upload_only=args.upload_only,
-                dry_run=dry_run)
+            _sync(kernel, repl, upload_only=args.upload_only, dry_run=dry_run, minify=args.minify)
         except (FileNotFoundError, ValueError) as e:
             kernel.error(e)
 
 
+def _sync(kernel, repl, *, dry_run=True, upload_only=True, minify=False):
+    # synchronize micrcontroller flash to host
+    #   dry_run: only print out differences, do not copy any files
+    #   upload_only: do not delete files on microcontroller that are not also on host
+    #   minify: upload minified .py files (compared by minified size & hash)
+    device = kernel.device
+    out = kernel.data_consumer
+    if not dry_run:
+        # sync mcu time to host if they differ by more than 3 seconds
+        repl.sync_time(3)
+    minifier = Minifier() if minify else None
+    listing, manifest, index, del_, add_, upd_ = _changes(kernel, repl, minifier)
+    same = True
+    for dst_file in del_:
+        # delete first (protect against a bug that deletes what was just copied)
+        if not upload_only:
+            same = False
+            out(colored(f"DELETE  {dst_file}\n", 'red'))
+            if not dry_run:
+                repl.rm_rf(dst_file)
+                for f in list(listing):
+                    if f == dst_file or f.startswith(dst_file + '/'):
+                        del listing[f]
+    for dst_file, src_file in add_.items():
+        # no feedback about directory creation
+        if os.path.isfile(src_file):
+            same = False
+            out(colored(f"ADD     {dst_file}\n", 'green'))
+    for dst_file, src_file in upd_.items():
+        same = False
+        out(colored(f"UPDATE  {dst_file}\n", 'blue'))
+    if not dry_run:
+        pairs = [ (src, dst) for dst, src in list(add_.items()) + list(upd_.items()) if os.path.isfile(src) ]
+        # directories (no host path) without files to upload, Transfer.put creates the others
+        dirs = [ dst for dst, src in add_.items()
+                 if not src and not any(f.startswith(dst + '/') for _, f in pairs) ]
+        for d in dirs:
+            repl.makedirs(d)
+        xfer = Transfer(kernel, repl, progress=False)
+        try:
+            xfer.put(pairs)
+        finally:
+            done = set(xfer.done)
+            checksums = _record(device, index, pairs, done)
+        # on failure the cached listing is out of date & ignored next time
+        if pairs or dirs or (del_ and not upload_only):
+            _update_listing(repl, listing, list(done) + dirs)
+            manifest.store(fingerprint(repl), listing, checksums)
+        if xfer.sent != xfer.bytes:
+            out(f"delta: sent {xfer.sent} of {xfer.bytes} bytes\n")
+        if minifier and pairs:
+            saved = minifier.saved(src for src, dst in pairs if dst in done)
+            out(f"minify: saved {saved} bytes\n")
+    if same:
+        out(colored("Directories match\n", 'green'))
+
+
+def _changes(kernel, repl, minifier=None):
+    # differences between host and mcu
+    # returns listing, manifest, index, del_, add_, upd_
+    device = kernel.device
+    config = device.config
+    # mcu files & excludes
+    excludes = []
+    for r in config.resources:
+        excludes.extend(getattr(r, 'excludes', []))
+    manifest = DeviceManifest(device.uid)
+    listing = _listing(repl, manifest, kernel.data_consumer)
+    mcu_files = { f: stat for f, stat in listing.items()
+                  if not any(fnmatch(f, ex) for ex in excludes) }
+    # host files
+    host_files = config.resource_files
+    index = HostIndex(config.name)
+    if minifier:
+        host_files = _minified(host_files, minifier, index)
+    del_, add_, upd_ = _diff(mcu_files, host_files, index, index.synced(device.uid))
+    return listing, manifest, index, del_, add_, upd_
+
+
+def _record(device, index, pairs, done):
+    # update index after uploading the files in done
+    # returns checksums of uploaded files, mcu_path -> sha256
+    checksums = {}
+    for src, dst in pairs:
+        if dst in done:
+            checksums[dst] = index.hash(src)
+            index.set_synced(device.uid, dst, checksums[dst])
+    index.save()
+    return checksums
+
+
+def _update_listing(repl, listing, paths):
+    # add uploaded files & created directories (and their parents) to listing,
+    # with mtime and size reported by the device
+    new = set()
+    for p in paths:
+        new.add(p)
+        d = os.path.dirname(p)
+        while d not in listing and d not in new:
+            new.add(d)
+            d = os.path.dirname(d)
+    listing.update(stat(repl, sorted(new)))
+
+
+def _minified(host_files, minifier, index):
+    # replace .py files by their minified version
+    # the minify cache is keyed by the hash in index: unchanged files are not read
+    result = {}
+    for mcu_path, (mtime, size, host_path) in host_files.items():
+        if size >= 0 and host_path.endswith('.py'):
+            path = minifier(host_path, index.hash(host_path))
+            minifier.sizes[path] = minifier.sizes.pop(host_path)
+            result[mcu_path] = (mtime, os.path.getsize(path), path)
+        else:
+            result[mcu_path] = (mtime, size, host_path)
+    return result
+
+
+def _listing(repl, manifest, out):
+    # files on the device: from the cached manifest if the fingerprint matches
+    fp = fingerprint(repl)
+    listing = manifest.files(fp)
+    if listing is None:
+        listing = repl.rlist('/', out)
+        manifest.store(fp, listing)
+    return listing
+
+
+def _show_listing(kernel, listing):
+    # print listing in the format of repl.rlist(show=True)
+    for path in sorted(listing):
+        if path == '/': continue
+        mtime, size = listing[path]
+        level = path.count('/') - 1
+        name = os.path.basename(path)
+        if size < 0:
+            kernel.print(f"{' ':7}  {' ':18} {' '*4*level}{colored(name + '/', 'green')}")
+        else:
+            mtime_fmt = datetime.fromtimestamp(mtime).strftime("%b %d %H:%M %Y")
+            kernel.print(f"{size:7}  {mtime_fmt:18} {' '*4*level}{colored(name, 'blue')}")
+
+
+def _diff(mcu_files, host_files, index, synced):
+    # determine difference between host (projects) and mcu
+    #   mcu_files:  mcu_path -> (mtime, size)
+    #   host_files: mcu_path -> (mtime, size, host_path)
+    #   synced:     mcu_path -> hash of last upload
+    # delete files not on host
+    to_delete = mcu_files.keys() - host_files.keys()
+    # add files from host
+    to_add = host_files.keys() - mcu_files.keys()
+    # in both: may need updating
+    to_update = set()
+    for u in mcu_files.keys() & host_files.keys():
+        mcu_time, mcu_size = mcu_files[u]
+        host_time, host_size, host_path = host_files[u]
+        # mcu_size < 0 indicates directory
+        if mcu_size < 0: continue
+        if mcu_size != host_size:
+            to_update.add(u)
+        elif mcu_time < host_time and synced.get(u) != index.hash(host_path):
+            # touched on host and content differs from last upload
+            to_update.add(u)
+    # convert to_add and to_update to ordered dicts full_path --> host_path
+    return (
+        sorted(to_delete, reverse=True),
+        OrderedDict(sorted({ k: host_files[k][-1] for k in to_add }.items())),
+        OrderedDict(sorted({ k: host_files[k][-1] for k in to_update }.items()))
+    )
+
+
 @line_magic
 def rlist_magic(kernel, _):
-    "List files on microcontroller"
-    with kernel.device as repl:
-        repl.rlist('/', kernel.data_consumer, show=True)
+    """List files on microcontroller
+The listing is cached on the host and retrieved from the device only
+if its file system changed."""
+    with kernel.repl_session as repl:
+        manifest = DeviceManifest(kernel.device.uid)
+        fp = fingerprint(repl)
+        listing = manifest.files(fp)
+        if listing is None:
+            listing = repl.rlist('/', kernel.data_consumer, show=True)
+            manifest.store(fp, listing)
+        else:
+            _show_listing(kernel, listing)
 
+@arg('-m', '--minify', action='store_true', help="compare against minified .py files")
 @arg('-u', '--upload_only', default=False, action='store_true', help="do not delete files on microcontroller that are not also on host")
 @line_magic
 def rdiff_magic(kernel, args):
@@ -25,6 +212,10 @@ def rdiff_magic(kernel, args):
     _rsync(kernel, args, True)
 
 
+@arg('--interval', type=float, default=0.5, help="watch: seconds between checks for changes (default: 0.5)")
+@arg('--stop', action='store_true', help="stop watching for changes (all devices)")
+@arg('-w', '--watch', action='store_true', help="after synchronizing, keep uploading files as they change on the host")
+@arg('-m', '--minify', action='store_true', help="strip comments, docstrings and whitespace from .py files before uploading")
 @arg('-u', '--upload_only', default=False, action='store_true', help="do not delete files on microcontroller that are not also on host")
 @line_magic
 def rsync_magic(kernel, args):
@@ -35,7 +226,121 @@ starting with a period.
 
 The list of files to upload is taken from the yaml device configuration.
 
+Files are compared by size and modification time. Files whose content
+is unchanged since the last upload (e.g. after a checkout) are skipped;
+hashes of host files are kept in ~/.iot49_rsync_index and recomputed
+only for files whose modification time or size changed.
+
+Large files (8 kB or more) already on the microcontroller are updated
+by sending only the blocks that changed.
+
 %rsync synchronizes the time on the microcontroller to the host if
 they differ by more than a few seconds to ensure correct updates.
+
+With --watch the host directories are checked for changes in the
+background (stat polling) and modified or new files are uploaded as
+soon as a burst of saves has settled. Deletions are not propagated.
+Uploads update the cached device listing, so a later %rsync does not
+send them again. Run %rsync --stop to end watching (of all devices).
+
+With --minify, comments, docstrings and redundant whitespace are
+stripped from .py files before uploading. Minified files are cached in
+~/.iot49_minify_cache, keyed by the hash of the source. Use the same
+option with %rdiff.
+
+Examples:
+    %rsync
+    %rsync --minify
+    %rsync --watch
+    %rsync --stop
 """
+    if args.stop:
+        if not _watchers:
+            kernel.error("Not watching")
+        while _watchers:
+            device, watcher = _watchers.popitem()
+            watcher.stop()
+            kernel.print(f"Stopped watching for {device.name}")
+        return
     _rsync(kernel, args, False)
+    if args.watch:
+        if kernel.device in _watchers:
+            kernel.error(f"Already watching for {kernel.device.name}")
+            return
+        watcher = _Watcher(kernel, kernel.device, args.interval, minify=args.minify)
+        _watchers[kernel.device] = watcher
+        watcher.start()
+        kernel.print(f"Watching for changes, %rsync --stop to end")
+
+
+# device -> _Watcher
+_watchers = {}
+
+class _Watcher(threading.Thread):
+    """Upload host files of device configuration when they change"""
+
+    def __init__(self, kernel, device, interval=0.5, settle=0.3, minify=False):
+        super().__init__(daemon=True)
+        self.kernel = kernel
+        self.device = device
+        self.minifier = Minifier() if minify else None
+        self.interval = interval
+        self.settle = settle
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        snapshot = self._snapshot()
+        while not self._stop_event.wait(self.interval):
+            try:
+                changed = self._changes(snapshot)
+                if not changed: continue
+                # debounce: wait until a burst of saves has settled
+                while not self._stop_event.wait(self.settle):
+                    more = self._changes(snapshot)
+                    if not more: break
+                    changed.update(more)
+                self._push(changed)
+            except Exception as e:
+                self.kernel.error(f"rsync --watch {self.device.name}: {type(e).__name__}: {e}")
+
+    def _snapshot(self):
+        # mcu_path -> (mtime, size, host_path)
+        return self.device.config.resource_files
+
+    def _changes(self, snapshot):
+        # dict mcu_path -> host_path of new or modified files; updates snapshot
+        current = self._snapshot()
+        changed = {}
+        for mcu_path, stat in current.items():
+            if stat[1] >= 0 and snapshot.get(mcu_path) != stat:
+                changed[mcu_path] = stat[2]
+        snapshot.clear()
+        snapshot.update(current)
+        return changed
+
+    def _push(self, changed):
+        pairs = [ (src, dst) for dst, src in sorted(changed.items()) if os.path.isfile(src) ]
+        if not pairs: return
+        index = HostIndex(self.device.config.name)
+        if self.minifier:
+            pairs = [ (self.minifier(src, index.hash(src)), dst) for src, dst in pairs ]
+        manifest = DeviceManifest(self.device.uid)
+        start = time.monotonic()
+        with self.kernel.repl_session_for(self.device) as repl:
+            # cached listing, None if out of date
+            listing = manifest.files(fingerprint(repl))
+            xfer = Transfer(self.kernel, repl, progress=False)
+            try:
+                xfer.put(pairs)
+            finally:
+                done = set(xfer.done)
+                checksums = _record(self.device, index, pairs, done)
+            if listing is not None:
+                _update_listing(repl, listing, list(done))
+                manifest.store(fingerprint(repl), listing, checksums)
+        names = ', '.join(dst for _, dst in pairs)
+        self.kernel.print(colored(f"UPLOAD  {names} ({xfer.sent} bytes, {time.monotonic()-start:.2f}s)", 'blue'))
@@ -5,7 +5,7 @@ import os, json
 
 
 def mcu2storage(kernel, name):
-    with kernel.device as repl:
+    with kernel.repl_session as repl:
         res = repl.exec(f"import json\nprint(json.dumps({name}))")
         logger.debug(f"{name} = {res}")
         kernel.shell.db['autorestore/' + name] = json.loads(res)
@@ -16,7 +16,7 @@ def storage2mcu(kernel, name):
     except KeyError:
         kernel.error(f"no variable with name '{name}' in storage")
     else:
-        with kernel.device as repl:
+        with kernel.repl_session as repl:
             try:
                 repl.exec(f"import json\n{name} = json.loads({repr(json.dumps(obj))})")
             except TypeError as te:
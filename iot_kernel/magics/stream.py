@@ -0,0 +1,326 @@
+from .magic import cell_magic, arg
+from ..output import OutputBuffer
+from ..kernel_logger import logger
+
+import base64, collections, io, re, threading
+
+# %%stream
+
+# key=value pairs, e.g. "t=1.5 temp=23.1, rh=45"
+_KV = re.compile(r'([A-Za-z_]\w*)\s*=\s*([^\s,;]+)')
+
+
+class _RingBuffer:
+    """Last size values of a series (float64)"""
+
+    def __init__(self, np, size):
+        self._np = np
+        self._data = np.empty(size)
+        # number of values written
+        self.count = 0
+
+    def extend(self, values):
+        size = len(self._data)
+        v = values[-size:]
+        i = (self.count + len(values) - len(v)) % size
+        k = min(len(v), size - i)
+        self._data[i:i+k] = v[:k]
+        self._data[:len(v)-k] = v[k:]
+        self.count += len(values)
+
+    def array(self):
+        """Values in chronological order (copy)"""
+        size = len(self._data)
+        if self.count <= size:
+            return self._data[:self.count].copy()
+        i = self.count % size
+        return self._np.concatenate((self._data[i:], self._data[:i]))
+
+    @property
+    def last(self):
+        return self._data[(self.count - 1) % len(self._data)]
+
+
+class _Capture:
+    """Receives device output (kernel.output_view), parses numeric lines into
+    ring buffers and refreshes a plot or table at most rate times per second.
+    Other lines are passed on to the notebook."""
+
+    def __init__(self, kernel, np, args, view):
+        self._kernel = kernel
+        self._np = np
+        self._size = args.size
+        self._format = None if args.format == 'auto' else args.format
+        self._names = [ c.strip() for c in args.columns.split(',') ] if args.columns else None
+        self._x = args.x
+        self._view = view
+        self._interval = 1 / args.rate
+        # column name -> _RingBuffer
+        self.columns = {}
+        self._partial = ''
+        # last lines seen before the format was detected (csv header candidates)
+        self._before = collections.deque(maxlen=8)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._shown = False
+        self._timer = None
+        self._figure = None
+        self._display_id = f"iot49-stream-{id(self)}"
+        self._parent = kernel.get_parent()
+        # parse in batches
+        self._buffer = OutputBuffer(self._batch, max_size=65536, interval=0.1)
+
+    def write(self, name, text):
+        self._buffer.write(name, text)
+
+    def flush(self, final=False):
+        self._buffer.flush(final)
+
+    def close(self):
+        """Parse remaining output and show the final view"""
+        self._buffer.flush(final=True)
+        if self._partial:
+            self._batch('stdout', '\n')
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        self._refresh()
+
+    def arrays(self):
+        with self._lock:
+            return { name: ring.array() for name, ring in self.columns.items() }
+
+    ###########################################################################
+    # parsing
+
+    def _batch(self, name, text):
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        if not lines: return
+        if not self._format or not (self._format == 'kv' or self._names):
+            self._detect(lines)
+        np = self._np
+        lines = np.array(lines)
+        if not self._format or not (self._format == 'kv' or self._names):
+            # no data yet: the last line may be the csv header
+            rest = lines
+            self._before.extend(l for l in rest if l.strip())
+        elif self._format == 'kv':
+            is_data = np.char.find(lines, '=') >= 0
+            self._parse_kv(lines[is_data])
+            rest = lines[~is_data]
+        else:
+            rest = self._parse_csv(lines)
+        text = '\n'.join(l for l in rest if l.strip())
+        if text: self._kernel.write('stdout', text + '\n')
+        self._changed()
+
+    def _detect(self, lines):
+        # determine format and csv columns from the first data line
+        # a csv header is the last preceding line with the same number of fields (removed
+        # from lines), possibly from an earlier batch
+        for i, line in enumerate(lines):
+            line = line.strip()
+            if not line: continue
+            if self._format != 'csv' and _KV.search(line):
+                self._format = 'kv'
+                return
+            fields = line.split(',')
+            if self._format != 'kv' and all(_is_float(f) for f in fields):
+                self._format = 'csv'
+                if not self._names:
+                    self._names = [ f"c{k}" for k in range(len(fields)) ]
+                    n = len(fields) - 1
+                    j = next((j for j in range(i-1, -1, -1) if lines[j].strip() and lines[j].count(',') == n), None)
+                    header = lines[j] if j is not None else \
+                        next((l for l in reversed(self._before) if l.count(',') == n), None)
+                    if header is not None:
+                        self._names = [ f.strip() for f in header.split(',') ]
+                        if j is not None: del lines[j]
+                return
+
+    def _parse_kv(self, lines):
+        np = self._np
+        pairs = _KV.findall('\n'.join(lines))
+        if not pairs: return
+        keys = np.array([ k for k, _ in pairs ])
+        values = _floats(np, [ v for _, v in pairs ])
+        with self._lock:
+            for key in dict.fromkeys(keys.tolist()):
+                self._column(key).extend(values[keys == key])
+
+    def _parse_csv(self, lines):
+        # returns lines that are not data
+        np = self._np
+        stripped = np.char.strip(lines)
+        commas = np.char.count(stripped, ',')
+        n = len(self._names)
+        is_data = (commas == n - 1) & (np.char.str_len(stripped) > 0)
+        data = stripped[is_data]
+        if len(data):
+            try:
+                values = np.array(','.join(data).split(','), dtype=float)
+            except ValueError:
+                # some lines are not numeric: find them, one at a time
+                ok = np.array([ all(_is_float(f) for f in l.split(',')) for l in data ])
+                is_data[np.flatnonzero(is_data)[~ok]] = False
+                data = data[ok]
+                values = np.array(','.join(data).split(','), dtype=float) if len(data) else np.empty(0)
+            values = values.reshape(-1, n)
+            with self._lock:
+                for k, name in enumerate(self._names):
+                    self._column(name).extend(values[:, k])
+        return lines[~is_data & (np.char.str_len(stripped) > 0)]
+
+    def _column(self, name):
+        ring = self.columns.get(name)
+        if ring is None:
+            ring = self.columns[name] = _RingBuffer(self._np, self._size)
+        return ring
+
+    ###########################################################################
+    # view
+
+    def _changed(self):
+        if self._view == 'none': return
+        with self._lock:
+            self._dirty = True
+            if not self._timer:
+                self._timer = threading.Timer(self._interval, self._refresh)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _refresh(self):
+        with self._lock:
+            self._timer = None
+            if not self._dirty or not self.columns: return
+            self._dirty = False
+            try:
+                data = self._plot() if self._view == 'plot' else self._table()
+            except Exception as e:
+                logger.exception(f"%%stream: {e}")
+                return
+        self._kernel.send_iopub('update_display_data' if self._shown else 'display_data', {
+            'data': data,
+            'metadata': {},
+            'transient': { 'display_id': self._display_id },
+        }, self._parent)
+        self._shown = True
+
+    def _table(self):
+        w = max(8, max(len(name) for name in self.columns))
+        rows = [ f"{'':{w}} {'samples':>10} {'last':>12} {'min':>12} {'mean':>12} {'max':>12}" ]
+        for name, ring in self.columns.items():
+            a = ring.array()
+            if not len(a): continue
+            rows.append(f"{name:{w}} {ring.count:10} {ring.last:12.6g} {a.min():12.6g} "
+                        f"{a.mean():12.6g} {a.max():12.6g}")
+        return { 'text/plain': '\n'.join(rows) }
+
+    def _plot(self):
+        if not self._figure:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self._figure = Figure(figsize=(8, 3.5))
+            FigureCanvasAgg(self._figure)
+            self._axes = self._figure.add_subplot()
+            self._axes.grid(True)
+            self._lines = {}
+        ax = self._axes
+        xring = self.columns.get(self._x) if self._x else None
+        for name, ring in self.columns.items():
+            if ring is xring: continue
+            y = ring.array()
+            if xring:
+                x = xring.array()
+                m = min(len(x), len(y))
+                x, y = x[-m:], y[-m:]
+            else:
+                x = self._np.arange(ring.count - len(y), ring.count)
+            line = self._lines.get(name)
+            if line is None:
+                line, = ax.plot(x, y, label=name)
+                self._lines[name] = line
+                ax.legend(loc='upper left')
+            else:
+                line.set_data(x, y)
+        ax.set_xlabel(self._x or 'sample')
+        ax.relim()
+        ax.autoscale_view()
+        png = io.BytesIO()
+        self._figure.canvas.print_png(png)
+        return { 'image/png': base64.b64encode(png.getvalue()).decode(),
+                 'text/plain': f"<{', '.join(self._lines)}>" }
+
+
+def _is_float(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def _floats(np, strings):
+    # convert, non-numeric values become nan
+    try:
+        return np.array(strings, dtype=float)
+    except ValueError:
+        return np.array([ float(s) if _is_float(s) else np.nan for s in strings ])
+
+
+def _have_matplotlib():
+    import importlib.util
+    return importlib.util.find_spec('matplotlib') is not None
+
+
+@arg('--name', default='stream', help="host variable receiving the captured arrays (default: stream)")
+@arg('-x', default=None, metavar='COLUMN', help="column used as x axis of the plot (default: sample number)")
+@arg('-r', '--rate', type=float, default=2, help="view refreshes per second (default: 2)")
+@arg('-v', '--view', choices=['plot', 'table', 'none'], default=None, help="live view (default: plot if matplotlib is installed, otherwise table)")
+@arg('-c', '--columns', default=None, help="comma separated column names (csv)")
+@arg('-f', '--format', choices=['auto', 'csv', 'kv'], default='auto', help="line format: csv (1.2,3.4) or kv (t=1.2 v=3.4); default: auto")
+@arg('-n', '--size', type=int, default=10000, help="samples kept per column (default: 10000)")
+@cell_magic
+def stream_magic(kernel, args, code):
+    """Capture numbers printed by the microcontroller into NumPy arrays
+Runs the cell on the device and parses its output lines, either comma
+separated values (optionally starting with a header line) or key=value
+pairs. The last --size values of each column are kept and shown in a
+live plot or table that is refreshed at most --rate times per second.
+Lines that are not data are shown as usual.
+
+When the cell ends (or is interrupted) the host variable --name is set
+to a dict of column name -> numpy array, e.g. for use in a %%host cell.
+
+Requires numpy; the plot requires matplotlib.
+
+Example:
+    %%stream -x t
+    import time
+    for i in range(1000):
+        print("t={} adc={}".format(time.ticks_ms(), adc.read()))
+        time.sleep_ms(10)
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        kernel.stop("%%stream requires numpy (pip install numpy)")
+    if args.size < 1 or args.rate <= 0:
+        kernel.stop("size and rate must be positive")
+    view = args.view or ('plot' if _have_matplotlib() else 'table')
+    capture = _Capture(kernel, np, args, view)
+    try:
+        with kernel.output_view(capture):
+            kernel.execute_cell(code)
+    finally:
+        capture.close()
+        arrays = capture.arrays()
+        kernel.shell.user_ns[args.name] = arrays
+        if arrays and args.x and args.x not in arrays:
+            kernel.error(f"-x {args.x}: no such column (columns: {', '.join(arrays)})")
+        if arrays:
+            n = max(ring.count for ring in capture.columns.values())
+            kernel.print(f"{args.name}: {', '.join(arrays)} ({n} samples"
+                         f"{', kept ' + str(args.size) if n > args.size else ''})")
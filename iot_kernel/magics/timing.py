@@ -0,0 +1,125 @@
+from .magic import raw_line_magic, cell_magic, arg
+import math, time
+
+# %time, %%timeit
+
+# marks the line with timing results in the device output
+_MARK = '@iot49-time@'
+
+# ticks_us, or a substitute on ports without it (e.g. CircuitPython)
+_TICKS = """
+import time as _t
+try:
+    _tu, _td = _t.ticks_us, _t.ticks_diff
+except AttributeError:
+    _tu, _td = (lambda: _t.monotonic_ns() // 1000), (lambda a, b: a - b)
+"""
+
+
+def _indent(code, n):
+    return '\n'.join(' '*n + line for line in code.strip('\n').split('\n'))
+
+
+def _program(setup, body, names):
+    # names (assigned by _TICKS & setup) are deleted from the device globals even if body raises
+    return f"{_TICKS}\n{setup}\ntry:\n{_indent(body, 4)}\nfinally:\n    del {', '.join(names)}\n"
+
+
+def _run(kernel, repl, code):
+    # execute code on device, return (timing results, host round trip in s)
+    # forwards all output other than the results to the notebook
+    result = []
+    def consumer(data):
+        if isinstance(data, str): data = data.encode()
+        result.append(data)
+    start = time.monotonic()
+    repl.exec(code, data_consumer=consumer, timeout=1000000000)
+    round_trip = time.monotonic() - start
+    out = []
+    values = None
+    # decode once: chunks may split multibyte characters
+    for line in b''.join(result).decode(errors='replace').split('\n'):
+        if line.strip().startswith(_MARK):
+            values = [ int(v) for v in line.strip()[len(_MARK):].split() ]
+        else:
+            out.append(line)
+    out = '\n'.join(out)
+    if out.strip(): kernel.data_consumer(out)
+    return values, round_trip
+
+
+def _fmt(us):
+    # format time given in microseconds
+    for unit, scale in (('s', 1e6), ('ms', 1e3)):
+        if us >= scale: return f"{us/scale:.3g} {unit}"
+    return f"{us:.3g} us"
+
+
+@raw_line_magic
+def time_magic(kernel, args):
+    """Time execution of a statement on the microcontroller
+Prints the time measured on the device (time.ticks_us) and, separately,
+the round trip time measured on the host. The difference is the overhead
+of the transport (serial, network) and raw repl.
+
+Example:
+    %time x = sum(range(10000))
+"""
+    if not args.line: return
+    code = _program("_t0 = _tu()", f"{args.line}\nprint('{_MARK}', _td(_tu(), _t0))",
+                    ('_t', '_t0', '_tu', '_td'))
+    with kernel.repl_session as repl:
+        values, round_trip = _run(kernel, repl, code)
+    if not values: return
+    device = values[0]
+    kernel.print(f"device: {_fmt(device)}, round trip: {_fmt(round_trip*1e6)} "
+                 f"(transport & repl {_fmt(max(round_trip*1e6-device, 0))})")
+
+
+@arg('-r', '--repeat', type=int, default=5, help="number of repeats (default: 5)")
+@arg('-n', '--number', type=int, default=0, help="executions per repeat (default: determined automatically)")
+@arg('-s', '--setup', default='pass', help="setup statement, executed once before timing")
+@cell_magic
+def timeit_magic(kernel, args, code):
+    """Time execution of the cell on the microcontroller
+The cell is run number times in each of repeat loops on the device and
+timed with time.ticks_us. Reports mean, standard deviation and minimum
+per run, and the host round trip time of the whole measurement.
+
+Like IPython's %%timeit, the code runs in a function, i.e. variables
+assigned in the cell are local. Globals (e.g. from earlier cells) are
+accessible.
+
+Example:
+    %%timeit -n 1000 -r 7 -s "import math"
+    math.sqrt(2)
+"""
+    if not code.strip(): return
+    setup = args.setup
+    def template(number, repeat):
+        return _program(f"""def _iot49_timeit():
+{_indent(setup, 4)}
+    _r = []
+    for _ in range({repeat}):
+        _t0 = _tu()
+        for _ in range({number}):
+{_indent(code, 12)}
+        _r.append(_td(_tu(), _t0))
+    print('{_MARK}', *_r)""", "_iot49_timeit()", ('_iot49_timeit', '_t', '_tu', '_td'))
+    with kernel.repl_session as repl:
+        number = args.number
+        if number < 1:
+            # calibrate: about 0.2 s per repeat
+            values, _ = _run(kernel, repl, template(1, 1))
+            if not values: return
+            number = 10 ** max(0, min(6, int(math.log10(0.2e6 / max(values[0], 1)))))
+        values, round_trip = _run(kernel, repl, template(number, args.repeat))
+    if not values: return
+    per_run = [ v / number for v in values ]
+    mean = sum(per_run) / len(per_run)
+    std = math.sqrt(sum((v - mean)**2 for v in per_run) / len(per_run))
+    kernel.print(f"{_fmt(mean)} ± {_fmt(std)} per loop (mean ± std. dev. of {len(per_run)} runs, "
+                 f"{number} loops each), min {_fmt(min(per_run))}")
+    device = sum(values)
+    kernel.print(f"device: {_fmt(device)}, round trip: {_fmt(round_trip*1e6)} "
+                 f"(transport & repl {_fmt(max(round_trip*1e6-device, 0))})")
@@ -0,0 +1,172 @@
+from .delta import put_delta
+import binascii, time, os
+
+"""Bulk file transfer between host and microcontroller.
+
+Transfer.put converts host files to write statements and sends them in
+batches of up to batch_size characters, each executed with a single
+round trip to the device. Small files share a batch, large ones are
+split across several. Chunks are sent as bytes literals or, if shorter
+(binary or compressed data), base64 encoded. Both directions show a
+progress line and a summary.
+
+Files of at least delta_threshold bytes that already exist on the device
+are uploaded as block-level deltas (see delta.py).
+"""
+
+class Transfer:
+
+    def __init__(self, kernel, repl, chunk_size=512, batch_size=4096, progress=True, transform=None, delta_threshold=8192):
+        # chunk_size: bytes per write statement, batch_size: characters of code per exec
+        # transform(host_path) -> path of file to upload instead (e.g. Minifier)
+        # delta_threshold: None disables delta uploads
+        self.kernel = kernel
+        self.transform = transform
+        self.repl = repl
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.progress = progress
+        self.delta_threshold = delta_threshold
+        self.files = 0
+        self.bytes = 0
+        self.total = 0
+        # payload bytes sent over the link (less than bytes with delta uploads)
+        self.sent = 0
+        # characters of code sent by put (payload after encoding, plus statements)
+        self.wire = 0
+        # round trips (batches) sent by put
+        self.execs = 0
+        self._b64 = False
+        # file currently being transferred & completed (destination names)
+        self.current = None
+        self.done = []
+        self._start = time.monotonic()
+        self._last_progress = 0
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    def put(self, pairs):
+        """Copy host files to the microcontroller
+        pairs: list of (host_path, mcu_path)"""
+        pairs = [ (src, dst) for src, dst in pairs if os.path.isfile(src) ]
+        if self.transform:
+            pairs = [ (self.transform(src), dst) for src, dst in pairs ]
+        self.total += sum(os.path.getsize(src) for src, _ in pairs)
+        # create each directory only once
+        dirs = sorted(set(os.path.dirname(dst) for _, dst in pairs) - { '', '/' })
+        for d in dirs:
+            self.repl.makedirs(d)
+        if self.delta_threshold is not None:
+            pairs = self._put_deltas(pairs)
+        for batch in self._batches(pairs):
+            self._send(batch)
+
+    def _send(self, batch):
+        # execute a batch of statements in one round trip
+        self.current = batch[0][2]
+        code = '\n'.join(stmt for stmt, *_ in batch)
+        self.repl.exec(code)
+        self.wire += len(code)
+        self.execs += 1
+        for _, size, dst, last in batch:
+            self.bytes += size
+            self.sent += size
+            if last:
+                self.files += 1
+                self.done.append(dst)
+        self.current = batch[-1][2]
+        self.show_progress()
+
+    def _put_deltas(self, pairs):
+        # upload large files as deltas, return pairs that need a full upload
+        full = []
+        for src, dst in pairs:
+            size = os.path.getsize(src)
+            if size < self.delta_threshold:
+                full.append((src, dst))
+                continue
+            self.current = dst
+            sent = put_delta(self.repl, src, dst, self.chunk_size)
+            if sent is None:
+                full.append((src, dst))
+                continue
+            self.bytes += size
+            self.sent += sent
+            self.files += 1
+            self.done.append(dst)
+            self.show_progress()
+        return full
+
+    def get(self, pairs):
+        """Copy microcontroller files to the host
+        pairs: list of (mcu_path, host_path, size)"""
+        self.total += sum(max(size, 0) for _, _, size in pairs)
+        for src, dst, _ in pairs:
+            self.current = src
+            d = os.path.dirname(dst)
+            if d: os.makedirs(d, exist_ok=True)
+            self.repl.fget(src, dst, chunk_size=self.chunk_size)
+            self.bytes += os.path.getsize(dst)
+            self.sent += os.path.getsize(dst)
+            self.files += 1
+            self.done.append(dst)
+            self.show_progress()
+
+    def show_progress(self, final=False):
+        if not self.progress: return
+        now = time.monotonic()
+        if not final and now - self._last_progress < 0.2: return
+        self._last_progress = now
+        pct = f"{100*self.bytes/self.total:3.0f}% " if self.total else ""
+        self.kernel.print(f"\r{pct}{self.files} files {self.bytes/1024:.1f} kB {self.rate:.1f} kB/s", end='')
+        if final: self.kernel.print("")
+
+    @property
+    def rate(self):
+        return self.bytes / 1024 / max(self.elapsed, 1e-6)
+
+    def summary(self):
+        self.show_progress(final=True)
+        sent = f", {self.sent} sent" if self.sent != self.bytes else ""
+        self.kernel.print(f"{self.files} files, {self.bytes} bytes{sent} in {self.elapsed:.2f}s ({self.rate:.1f} kB/s)")
+
+    def _batches(self, pairs):
+        # statements grouped into batches of up to batch_size characters
+        batch, length = [], 0
+        for item in self._statements(pairs):
+            if batch and length + len(item[0]) > self.batch_size:
+                yield batch
+                batch, length = [], 0
+            batch.append(item)
+            length += len(item[0]) + 1
+        if batch: yield batch
+
+    def _statements(self, pairs):
+        # (statement, payload bytes, mcu_path, last statement of file)
+        for src, dst in pairs:
+            yield f"f=open({repr(dst)},'wb')\nw=f.write", 0, dst, False
+            with open(src, 'rb') as f:
+                while True:
+                    data = f.read(self.chunk_size)
+                    if not data: break
+                    yield self._write(data), len(data), dst, False
+            yield "f.close()", 0, dst, True
+
+    def _write(self, data):
+        # write statement, bytes literal or base64 (about 3x shorter for random data)
+        r = repr(data)
+        b = binascii.b2a_base64(data, newline=False).decode()
+        if len(b) + 5 >= len(r):
+            return f"w({r})"
+        if not self._b64:
+            self._b64 = True
+            return f"{_B64_IMPORT}\nw(_d('{b}'))"
+        return f"w(_d('{b}'))"
+
+
+_B64_IMPORT = """try:
+    from ubinascii import a2b_base64 as _d
+except ImportError:
+    from binascii import a2b_base64 as _d"""
@@ -7,7 +7,7 @@ from termcolor import colored
 import logging
 import os
 
-# %cd, %lsmagic, %%writefile
+# %cd, %lsmagic, %output, %%writefile
 
 
 @arg("path", nargs="?", default="~", help="new working directory on host")
@@ -45,6 +45,40 @@ def lsmagic_magic(kernel, args):
         if not v[1]: continue
         kernel.print("  %%{:10s} {}".format(k, v[1]))
 
+@arg('-r', '--rate', type=float, default=4, help="display refreshes per second in tail mode (default: 4)")
+@arg('lines', nargs='?', type=int, default=20, help="number of lines shown in tail mode (default: 20)")
+@arg('mode', nargs='?', choices=['all', 'tail'], help="all: show all output (default), tail: only the last lines")
+@line_magic
+def output_magic(kernel, args):
+    """Limit device output shown in the notebook
+In tail mode only the last lines printed by the device are kept (in a
+ring buffer) and shown in a single display area that is redrawn a few
+times per second, with a count of the dropped lines. Use it for chatty
+firmware: the notebook and message volume stay small regardless of the
+amount of output. Errors and messages from magics are not affected.
+
+The setting applies from the current cell on, including background jobs
+started afterwards.
+
+Examples:
+    %output tail 20        # show last 20 lines
+    %output tail 5 -r 10   # last 5 lines, redraw 10 times per second
+    %output all            # show all output (default)
+    %output                # show setting
+    """
+    if args.mode == 'tail':
+        if args.lines < 1 or args.rate <= 0:
+            kernel.stop("lines and rate must be positive")
+        kernel.output_tail = (args.lines, 1 / args.rate)
+    elif args.mode == 'all':
+        kernel.output_tail = None
+    elif kernel.output_tail:
+        lines, interval = kernel.output_tail
+        kernel.print(f"tail {lines} lines, {1/interval:g} refreshes per second")
+    else:
+        kernel.print("all")
+
+
 @arg('-a', '--append', action='store_true', help="Append to file. Default is overwrite.")
 @arg("path", help="file path")
 @cell_magic
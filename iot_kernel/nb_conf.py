@@ -1,48 +1,132 @@
 from iot_device import Env
-import ipynbname, os
-import json
+from .kernel_logger import logger
+import os
+import json, fcntl, tempfile, threading
 
-"""Store per notebook configuration as a dict. 
+"""Store per notebook configuration as a dict.
     Keys: "device", "cwd"
+
+The database (shared by all notebooks) is cached in memory and re-read
+only when the file changes on disk (mtime or size). Updates re-read the
+file under an exclusive lock, merge the entry of the active notebook,
+and replace the database atomically so that concurrent kernels do not
+overwrite each other's changes.
 """
 
+
 class NbConf:
 
     @staticmethod
     def get(key, default=None):
         """Return configuration parameter for active notebook"""
-        config = NbConf._load_config()
-        return config.get(key, default)
+        with NbConf._lock:
+            return NbConf._load_config().get(key, default)
 
     @staticmethod
     def set(key, uid_or_name_or_path):
         """Set configuration parameter for active notebook"""
-        config = NbConf._load_config()
-        config[key] = uid_or_name_or_path
-        NbConf._store_config(config)
+        NbConf.update({ key: uid_or_name_or_path })
+
+    @staticmethod
+    def update(changes:dict):
+        """Set several configuration parameters with a single write"""
+        with NbConf._lock:
+            config = NbConf._load_config()
+            if all(config.get(k) == v for k, v in changes.items()):
+                return
+            NbConf._store_config(changes)
 
 
     _DB = Env.expand_path(os.path.join('~', ".iot49_connect_rc"))
 
+    # in memory copy of _DB, and (mtime, size) of the file it was read from
+    _db = {}
+    _db_stat = None
+    # error from parsing _DB, None if it was read successfully
+    _db_error = None
+    # path of active notebook, None until it has been looked up successfully
+    _nb_path = None
+    _unsaved_reported = False
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _notebook():
+        """Path of the active notebook, None if it cannot be determined"""
+        if NbConf._nb_path is None:
+            try:
+                # ipynbname imports IPython: defer until needed
+                import ipynbname
+                NbConf._nb_path = str(ipynbname.path())
+            except Exception as e:
+                # retry on next call, e.g. early in kernel start-up
+                logger.debug(f"NbConf: cannot determine notebook path: {e}")
+        return NbConf._nb_path
+
     @staticmethod
-    def _store_config(config):
-        """Store config dict for active notebook"""
+    def _stat():
         try:
-            with open(NbConf._DB) as f:
-                db = json.loads(f.read())
+            st = os.stat(NbConf._DB)
+            return (st.st_mtime_ns, st.st_size)
         except FileNotFoundError:
-            db = {}
-        db[str(ipynbname.path())] = config
-        with open(NbConf._DB, 'w') as f:
-            json.dump(db, f, indent=4, sort_keys=True)
+            return None
+
+    @staticmethod
+    def _read_db():
+        """Contents of _DB, cached until the file changes"""
+        stat = NbConf._stat()
+        if stat != NbConf._db_stat:
+            NbConf._db_error = None
+            try:
+                with open(NbConf._DB) as f:
+                    NbConf._db = json.load(f)
+            except FileNotFoundError:
+                NbConf._db = {}
+            except ValueError as e:
+                # readers get defaults, _store_config refuses to overwrite the file
+                logger.error(f"NbConf: {NbConf._DB} is corrupt: {e}")
+                NbConf._db = {}
+                NbConf._db_error = e
+            NbConf._db_stat = stat
+        return NbConf._db
+
+    @staticmethod
+    def _store_config(changes):
+        """Merge changes into config dict for active notebook"""
+        nb = NbConf._notebook()
+        if not nb:
+            # e.g. jupyter console: report once, not for every %connect or %cd
+            if not NbConf._unsaved_reported:
+                NbConf._unsaved_reported = True
+                logger.error(f"NbConf: notebook path unknown, settings ({', '.join(changes)}) are not saved")
+            return
+        with open(NbConf._DB + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # pick up changes by other kernels
+            db = NbConf._read_db()
+            if NbConf._db_error:
+                # writing would discard the settings of all other notebooks
+                raise ValueError(f"{NbConf._DB} is corrupt ({NbConf._db_error}), fix or delete it")
+            config = dict(db.get(nb, {}))
+            config.update(changes)
+            db[nb] = config
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(NbConf._DB), prefix='.iot49_connect_rc.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(db, f, indent=4, sort_keys=True)
+                # mkstemp creates the file with mode 0600, keep that of the original
+                try:
+                    os.chmod(tmp, os.stat(NbConf._DB).st_mode & 0o7777)
+                except FileNotFoundError:
+                    pass
+                os.replace(tmp, NbConf._DB)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            NbConf._db_stat = NbConf._stat()
 
     @staticmethod
     def _load_config():
         """Load config dict for active notebook"""
-        try:
-            with open(NbConf._DB) as f:
-                db = json.load(f)
-                return db.get(str(ipynbname.path()), {})
-        except FileNotFoundError:
-            return {}
-
+        nb = NbConf._notebook()
+        if not nb: return {}
+        return NbConf._read_db().get(nb, {})
@@ -0,0 +1,150 @@
+from collections import deque
+import codecs, threading, time
+
+"""Coalesce output into fewer stream messages.
+
+Devices deliver output in arbitrary, often tiny, chunks. Sending each
+chunk as a separate iopub message floods the front end. OutputBuffer
+collects text and passes it on to sink(name, text) when
+
+* the buffer exceeds max_size characters,
+* a newline arrives and interval seconds have passed since the last flush,
+* a timer expires interval seconds after text was first buffered, or
+* flush() is called (e.g. at the end of the cell).
+
+Output to stdout and stderr is kept in order: switching streams flushes
+the buffer.
+"""
+
+class OutputBuffer:
+
+    def __init__(self, sink, max_size=8192, interval=0.05):
+        # interval None: no buffering, write through to sink
+        self._sink = sink
+        self._max_size = max_size
+        self._interval = interval
+        self._name = None
+        self._buffer = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._lock = threading.RLock()
+
+    def decode(self, data:bytes) -> str:
+        """Decode bytes, keeping incomplete multibyte characters for the next call"""
+        with self._lock:
+            return self._decoder.decode(data)
+
+    def write(self, name, text):
+        if not text: return
+        with self._lock:
+            if name != self._name:
+                self._flush()
+                self._name = name
+            self._buffer.append(text)
+            self._size += len(text)
+            if self._interval is None or self._size >= self._max_size:
+                self._flush()
+            elif '\n' in text and time.monotonic() - self._last_flush >= self._interval:
+                self._flush()
+            elif not self._timer:
+                self._timer = threading.Timer(self._interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self, final=False):
+        """Send buffered text to sink.
+        final: also emit partial multibyte characters (as replacement character)"""
+        with self._lock:
+            if final:
+                tail = self._decoder.decode(b'', final=True)
+                if tail: self.write(self._name or 'stdout', tail)
+            self._flush()
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._last_flush = time.monotonic()
+        if not self._buffer: return
+        text = ''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self._sink(self._name, text)
+
+
+class TailView:
+    """Show only the last lines of output in a single display area.
+
+    Lines are kept in a ring buffer of the given size; older lines are
+    dropped (and counted). The display (display_id) is created on the first
+    write and redrawn with update_display_data at most once per interval,
+    so memory and message volume stay bounded however much is printed.
+    send(msg_type, content) sends an iopub message.
+    """
+
+    # longest partial line kept (output without newlines)
+    MAX_LINE = 4096
+
+    def __init__(self, send, lines, interval=0.25, display_id='iot49-tail'):
+        self._send = send
+        self._lines = deque(maxlen=lines)
+        self._partial = ''
+        self._dropped = 0
+        self._interval = interval
+        self._display_id = display_id
+        self._shown = False
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def write(self, name, text):
+        if not text: return
+        with self._lock:
+            lines = (self._partial + text).split('\n')
+            self._partial = lines.pop()
+            if len(self._partial) > self.MAX_LINE:
+                lines.append(self._partial)
+                self._partial = ''
+            maxlen = self._lines.maxlen
+            if len(lines) > maxlen:
+                self._dropped += len(lines) - maxlen
+                lines = lines[-maxlen:]
+            self._dropped += max(0, len(self._lines) + len(lines) - maxlen)
+            self._lines.extend(lines)
+            self._dirty = True
+            if not self._timer:
+                self._timer = threading.Timer(self._interval, self._refresh)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self, final=False):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._update()
+
+    def _refresh(self):
+        with self._lock:
+            self._timer = None
+            self._update()
+
+    def _update(self):
+        if not self._dirty: return
+        lines = list(self._lines)
+        if self._partial: lines.append(self._partial)
+        if self._dropped:
+            lines.insert(0, f"... {self._dropped} lines dropped ...")
+        self._send('update_display_data' if self._shown else 'display_data', {
+            'data': { 'text/plain': '\n'.join(lines) },
+            'metadata': {},
+            'transient': { 'display_id': self._display_id },
+        })
+        self._shown = True
+        self._dirty = False
@@ -0,0 +1,241 @@
+from iot_device import RemoteError
+from iot_device.device import Device
+from .kernel_logger import logger
+from collections import deque
+import base64, json, threading, time
+
+"""Record and replay the byte stream between kernel and device.
+
+Recorder taps the read and write methods of a device (like Stats.tap)
+and writes the traffic, with timestamps, to a file: a JSON header with
+the device's uid, name and platform, followed by one JSON line
+[time, 'r' or 'w', base64 data] per chunk.
+
+ReplayDevice serves a recording in place of the device, e.g.
+
+    %connect 'replay://session.rec?speed=10'
+
+Data is returned to the kernel with the delays of the recording (relative
+to the write that triggered it), divided by speed. speed=0 replays
+without delays. Since device timing is reproduced independently of the
+host, this allows profiling output handling, magics etc. in isolation.
+"""
+
+SCHEME = 'replay'
+VERSION = 1
+
+# consecutive reads (or writes) less than this apart are stored as one chunk
+_COALESCE = 0.01
+# read timeout (s), same as SerialDevice
+_READ_TIMEOUT = 0.5
+
+
+class Recorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self._device = None
+        self._path = None
+
+    @property
+    def device(self):
+        """Device being recorded, None if not recording"""
+        return self._device
+
+    @property
+    def path(self):
+        return self._path
+
+    def start(self, device, path):
+        """Record traffic of device to file path"""
+        with self._lock:
+            if self._device:
+                raise ValueError(f"already recording {self._device.name} to {self._path}")
+            header = {
+                'version': VERSION,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'url': device.url,
+                'uid': device.uid,
+                'name': device.name,
+                'implementation': device.implementation,
+                'platform': device.platform,
+                'use_raw_paste': getattr(device, 'use_raw_paste', True),
+            }
+            self._file = open(path, 'w')
+            self._file.write(json.dumps(header) + '\n')
+            self._device = device
+            self._path = path
+            self._start = time.monotonic()
+            # [direction, time, data] of the chunk being collected
+            self._chunk = None
+            self._bytes = { 'r': 0, 'w': 0 }
+        self.tap(device)
+
+    def stop(self):
+        """Stop recording, returns dict with path, duration, bytes sent & received"""
+        with self._lock:
+            if not self._device: return None
+            self._write_chunk()
+            self._file.close()
+            result = { 'path': self._path, 'duration': time.monotonic() - self._start,
+                       'sent': self._bytes['w'], 'received': self._bytes['r'] }
+            self._file = self._device = None
+            return result
+
+    def tap(self, device):
+        """Wrap read and write of device (once), recording while device is being recorded"""
+        if getattr(device, '_iot49_recorder', None) is self: return
+        read = device.read
+        write = device.write
+        def tapped_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            if data and self._device is device: self._record('r', data)
+            return data
+        def tapped_write(data):
+            if self._device is device: self._record('w', data)
+            return write(data)
+        device.read = tapped_read
+        device.write = tapped_write
+        device._iot49_recorder = self
+
+    def _record(self, direction, data):
+        with self._lock:
+            if not self._file: return
+            now = time.monotonic() - self._start
+            self._bytes[direction] += len(data)
+            chunk = self._chunk
+            if chunk and chunk[0] == direction and now - chunk[1] < _COALESCE:
+                chunk[1] = now
+                chunk[2].extend(data)
+            else:
+                self._write_chunk()
+                self._chunk = [direction, now, bytearray(data)]
+
+    def _write_chunk(self):
+        chunk = self._chunk
+        if chunk:
+            direction, t, data = chunk
+            self._file.write(json.dumps([round(t, 6), direction, base64.b64encode(data).decode()]) + '\n')
+        self._chunk = None
+
+
+class ReplayDevice(Device):
+    """Device serving a recording made by Recorder
+
+    url: replay://path[?speed=S]
+    """
+
+    def __init__(self, url):
+        # no connection to a device, hence Device.__init__ is not called
+        self._url = url
+        path, _, query = self.address.partition('?')
+        params = dict(p.partition('=')[::2] for p in query.split('&') if p)
+        try:
+            self.speed = float(params.get('speed', 1))
+        except ValueError:
+            raise ValueError(f"invalid speed in {url}")
+        with open(path) as f:
+            self.header = json.loads(f.readline())
+            if self.header.get('version') != VERSION:
+                raise ValueError(f"{path}: unsupported recording version {self.header.get('version')}")
+            events = [ json.loads(line) for line in f if line.strip() ]
+        self._uid = self.header['uid']
+        self._implementation = self.header['implementation']
+        self._platform = self.header['platform']
+        self.use_raw_paste = self.header.get('use_raw_paste', True)
+        # reads: (data, bytes written before it, delay after that write or the previous read)
+        self._reads = []
+        writes = bytearray()
+        t_write = t_read = 0
+        for t, direction, data in events:
+            data = base64.b64decode(data)
+            if direction == 'w':
+                writes.extend(data)
+                t_write = t
+            else:
+                self._reads.append((data, len(writes), t - max(t_write, t_read)))
+                t_read = t
+        self._writes = bytes(writes)
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._next = 0
+        self._written = 0
+        # (bytes written, time) of writes not yet answered
+        self._write_times = deque()
+        self._due = time.monotonic()
+        self._diverged = False
+
+    @property
+    def name(self):
+        return self.header.get('name') or self.uid
+
+    @property
+    def remaining(self):
+        """Number of chunks not yet read"""
+        return len(self._reads) - self._next
+
+    def read(self, size=1):
+        deadline = time.monotonic() + _READ_TIMEOUT
+        data = bytearray()
+        while len(data) < size:
+            with self._lock:
+                wait = self._fill()
+                n = min(size - len(data), len(self._buffer))
+                data.extend(self._buffer[:n])
+                del self._buffer[:n]
+                if len(data) == size: break
+                if wait is None and not self._buffer:
+                    if data: break
+                    raise RemoteError(f"{self.url}: end of recording")
+            now = time.monotonic()
+            if now >= deadline: break
+            time.sleep(min(wait or 0.01, deadline - now))
+        return bytes(data)
+
+    def write(self, data):
+        with self._lock:
+            expected = self._writes[self._written:self._written+len(data)]
+            if expected != data and not self._diverged:
+                self._diverged = True
+                logger.warning(f"{self.url}: writes differ from recording at byte {self._written}, "
+                               f"got {bytes(data[:20])}, expected {expected[:20]}")
+            self._written += len(data)
+            self._write_times.append((self._written, time.monotonic()))
+        return len(data)
+
+    def inWaiting(self):
+        with self._lock:
+            if self._fill() is None and not self._buffer:
+                # Pyboard.read_until polls inWaiting, it would wait forever
+                raise RemoteError(f"{self.url}: end of recording")
+            return len(self._buffer)
+
+    def _fill(self):
+        # move chunks that are due to the buffer
+        # returns seconds until the next chunk is due, 0 if waiting for a write, None at the end
+        now = time.monotonic()
+        while self._next < len(self._reads):
+            data, written, delay = self._reads[self._next]
+            times = self._write_times
+            while times and times[0][0] < written:
+                times.popleft()
+            if written > 0:
+                if not times: return 0
+                due = max(times[0][1], self._due)
+            else:
+                due = self._due
+            if self.speed > 0: due += delay / self.speed
+            if due > now: return due - now
+            self._buffer.extend(data)
+            self._due = due
+            self._next += 1
+        return None
+
+    def __enter__(self):
+        from iot_device.repl_protocol import ReplProtocol
+        self._repl_protocol = ReplProtocol(self)
+        return self._repl_protocol
+
+    def __exit__(self, type, value, traceback):
+        self._repl_protocol.close()
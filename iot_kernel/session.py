@@ -0,0 +1,113 @@
+from iot_device import RemoteError
+from .kernel_logger import logger
+import threading, time
+
+"""Raw REPL session that can span several `with` blocks.
+
+Entering a device (`with device as repl`) opens the connection and
+enters the raw REPL. Session reuses that repl for all `with` blocks
+while it is held open, e.g. for the duration of a cell:
+
+    with kernel.repl_session as repl:
+        repl.exec(...)
+
+Once released, the session is closed immediately, or after
+idle_timeout seconds of inactivity if that is positive.
+"""
+
+class Session:
+
+    def __init__(self, device, held=lambda: False, stats=None):
+        # held(): True while the session should stay open after the last `with`
+        # stats: Stats, counts connects, connect time & bytes transferred
+        self._device = device
+        self._held = held
+        self._stats = stats
+        self._repl = None
+        self._depth = 0
+        self._timer = None
+        self._lock = threading.RLock()
+        self.idle_timeout = 0
+
+    @property
+    def device(self):
+        return self._device
+
+    @property
+    def is_open(self):
+        return self._repl is not None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self._cancel_timer()
+            if self._repl is None:
+                logger.debug(f"session: open {self._device.url}")
+                start = time.monotonic()
+                if self._stats and self._stats.transport: self._stats.tap(self._device)
+                self._repl = self._device.__enter__()
+                if self._stats:
+                    name = self._device.name
+                    self._stats.add(name, 'enters')
+                    self._stats.add(name, 'connect', time.monotonic() - start)
+            self._depth += 1
+            return self._repl
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def __exit__(self, typ, value, traceback):
+        from .kernel import StopDoExecute
+        try:
+            self._depth -= 1
+            if typ and not (issubclass(typ, StopDoExecute) or _device_error(value)):
+                # connection state unknown (interrupt, transport error, disconnect, ...)
+                self.close()
+            elif self._depth == 0 and not self._held():
+                self.release()
+        finally:
+            self._lock.release()
+
+    def release(self):
+        """Close now or after idle_timeout"""
+        with self._lock:
+            if self._depth > 0 or self._repl is None: return
+            if self.idle_timeout > 0:
+                if not self._timer:
+                    self._timer = threading.Timer(self.idle_timeout, self.release_idle)
+                    self._timer.daemon = True
+                    self._timer.start()
+            else:
+                self.close()
+
+    def release_idle(self):
+        with self._lock:
+            self._timer = None
+            if self._depth == 0 and not self._held():
+                self.close()
+
+    def close(self):
+        """Exit the raw REPL and close the connection"""
+        with self._lock:
+            self._cancel_timer()
+            if self._repl is None: return
+            logger.debug(f"session: close {self._device.url}")
+            self._repl = None
+            try:
+                self._device.__exit__(None, None, None)
+            except Exception as e:
+                logger.info(f"session: error closing {self._device.url}: {e}")
+            if self._stats: self._stats.untap(self._device)
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+
+def _device_error(e):
+    """True if e reports an exception raised by code on the device.
+    The repl is still usable. Other RemoteErrors, e.g. "Device disconnected"
+    (ReplProtocol maps OSError to RemoteError) or protocol errors entering
+    the raw repl, leave the connection in an unknown state."""
+    return isinstance(e, RemoteError) and any('Traceback' in str(a) for a in e.args)
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+import threading, time
+
+"""Transport and execution statistics per device.
+
+Counters are kept for the current cell and cumulatively. The numbers of
+the previous cell are retained so that they can be shown by %stats in
+the next cell.
+
+Bytes sent and received are counted by wrapping the read and write
+methods of the device (see tap), i.e. they include the raw repl
+protocol overhead. Since Pydevice reads output one byte at a time, this
+is enabled only on request (transport = True). The taps count without
+locking; the counts are added to the statistics when these are read.
+"""
+
+# name -> (description, format)
+FIELDS = OrderedDict([
+    ('cells',     ("cells",                     "{:d}")),
+    ('sent',      ("bytes sent",                "{:d}")),
+    ('received',  ("bytes received",            "{:d}")),
+    ('output',    ("bytes of output",           "{:d}")),
+    ('enters',    ("raw repl enters",           "{:d}")),
+    ('connect',   ("connect time [s]",          "{:.3f}")),
+    ('exec',      ("code execution time [s]",   "{:.3f}")),
+    ('magic',     ("host magic time [s]",       "{:.3f}")),
+])
+
+# statistics of magics not associated with a device
+HOST = '(host)'
+
+
+def _zero():
+    return { k: 0 for k in FIELDS }
+
+
+class Stats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # device name -> counters
+        self._cell = {}
+        self._previous = {}
+        self._total = {}
+        # count bytes sent and received (taps installed by Session)
+        self.transport = False
+        # device -> [bytes sent, bytes received] not yet added to the counters
+        self._taps = {}
+
+    def add(self, name, field, value=1):
+        with self._lock:
+            self._add(name, field, value)
+
+    def _add(self, name, field, value):
+        for d in (self._cell, self._total):
+            counters = d.get(name)
+            if counters is None:
+                counters = d[name] = _zero()
+            counters[field] += value
+
+    def _collect(self):
+        # add byte counts of taps to the counters (lock held)
+        for device, counts in self._taps.items():
+            sent, received = counts
+            if sent: self._add(device.name, 'sent', sent)
+            if received: self._add(device.name, 'received', received)
+            counts[0] -= sent
+            counts[1] -= received
+
+    def begin_cell(self):
+        with self._lock:
+            self._collect()
+            self._previous = self._cell
+            self._cell = {}
+
+    def reset(self):
+        with self._lock:
+            self._cell = {}
+            self._previous = {}
+            self._total = {}
+
+    @property
+    def previous(self):
+        """Counters of the previous cell, device name -> { field: value }"""
+        with self._lock:
+            self._collect()
+            return { k: dict(v) for k, v in self._previous.items() }
+
+    @property
+    def total(self):
+        """Cumulative counters, device name -> { field: value }"""
+        with self._lock:
+            self._collect()
+            return { k: dict(v) for k, v in self._total.items() }
+
+    def timer(self, name, field):
+        """Context manager adding the time spent in the block to field"""
+        return _Timer(self, name, field)
+
+    def tap(self, device):
+        """Count bytes read from and written to device, until untap"""
+        if getattr(device, '_iot49_stats', None): return
+        counts = [0, 0]
+        read = device.read
+        write = device.write
+        def tapped_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            if data: counts[1] += len(data)
+            return data
+        def tapped_write(data):
+            counts[0] += len(data)
+            return write(data)
+        device.read = tapped_read
+        device.write = tapped_write
+        device._iot49_stats = (tapped_read, read, write)
+        with self._lock:
+            self._taps[device] = counts
+
+    def untap(self, device):
+        """Remove the tap of device (unless wrapped again since, e.g. by Recorder)"""
+        tap = getattr(device, '_iot49_stats', None)
+        if not tap or device.read is not tap[0]: return
+        device.read, device.write = tap[1], tap[2]
+        device._iot49_stats = None
+        with self._lock:
+            self._collect()
+            self._taps.pop(device, None)
+
+
+class _Timer:
+
+    def __init__(self, stats, name, field):
+        self.stats = stats
+        self.name = name
+        self.field = field
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *args):
+        self.stats.add(self.name, self.field, time.monotonic() - self.start)